@@ -0,0 +1,8 @@
+"""
+Benchmarks on synthetic corpora, run from the repository root:
+
+    python -m benchmark run [--quick] [--workers N] [--out FILE] [--workdir DIR] [--only NAME ...]
+    python -m benchmark compare OLD NEW [--tolerance 0.1]
+
+run writes the results as json, compare exits with 1 if a metric got worse than the tolerance.
+"""
@@ -0,0 +1,55 @@
+import sys
+import json
+import argparse
+from benchmark import suite
+
+
+def _run(args):
+    results = suite.run(args.quick, args.workers, args.workdir, args.only)
+    for name, metric in results['metrics'].items():
+        print('%-30s %12.2f %-12s %s' % (name, metric['value'], metric['unit'],
+                                         'MISSED TARGET %g' % metric['target'] if suite.missed_target(metric) else ''))
+    if args.out:
+        with open(args.out, mode='w') as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+def _compare(args):
+    with open(args.old, mode='r') as file:
+        old = json.load(file)
+    with open(args.new, mode='r') as file:
+        new = json.load(file)
+    if old['config'] != new['config']:
+        print('warning: the runs used different corpora or settings')
+    regressions = 0
+    for name, before, after, change, regressed in suite.compare(old, new, args.tolerance):
+        regressions += regressed
+        print('%-30s %12.2f %12.2f %+7.1f%% %s' % (name, before, after, change * 100, 'REGRESSION' if regressed else ''))
+    return 1 if regressions > 0 else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark', description='Benchmarks on synthetic video corpora')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='generate a corpus and run the benchmarks')
+    run.add_argument('--quick', action='store_true', help='smaller corpus and fewer rounds')
+    run.add_argument('--workers', type=int, help='indexing workers, the number of cpus by default')
+    run.add_argument('--out', help='write the results to this json file')
+    run.add_argument('--workdir', help='keep the corpus and caches in this folder')
+    run.add_argument('--only', nargs='+', choices=[bench.__name__[len('bench_'):] for bench in suite.benchmarks])
+    run.set_defaults(func=_run)
+
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as noise')
+    compare.set_defaults(func=_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
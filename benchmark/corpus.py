@@ -0,0 +1,76 @@
+import os
+import cv2
+import numpy as np
+
+# (fourcc, suffix) pairs tried for the corpus, codecs the local OpenCV build can not write are skipped
+codecs = [('mp4v', '.mp4'), ('MJPG', '.avi'), ('XVID', '.avi')]
+resolutions = [(320, 240), (640, 360), (1280, 720)]
+lengths = [150, 600]
+
+
+def make_video(path, size=(320, 240), frames=300, fps=25, codec='mp4v', scenes=6, seed=0):
+    """
+    write a synthetic video of flat coloured scenes with a moving circle, the same seed gives the same video
+    :return: True if the video was written
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, size)
+    if not writer.isOpened():
+        return False
+    rng = np.random.default_rng(seed)
+    colours = rng.integers(0, 255, (scenes, 3))
+    img = np.zeros((size[1], size[0], 3), np.uint8)
+    for i in range(frames):
+        scene = i * scenes // frames
+        img[:] = colours[scene]
+        # the first scene stays black, like the fade in of most videos
+        if scene > 0:
+            cv2.circle(img, (i * 4 % size[0], size[1] // 2), size[1] // 8, (255 - colours[scene]).tolist(), -1)
+        writer.write(img)
+    writer.release()
+    return os.path.getsize(path) > 0
+
+
+def make_corpus(folder, quick=False):
+    """
+    one video per codec, resolution and length
+    :return: list of (path, codec, (width, height), frames) of the written videos
+    """
+    os.makedirs(folder, exist_ok=True)
+    videos = []
+    seed = 0
+    for codec, suffix in codecs:
+        for size in resolutions[:2] if quick else resolutions:
+            for frames in lengths[:1] if quick else lengths:
+                seed += 1
+                path = os.path.join(folder, '%s_%dx%d_%d%s' % (codec, size[0], size[1], frames, suffix))
+                if make_video(path, size, frames, codec=codec, seed=seed):
+                    videos.append((path, codec, size, frames))
+                elif os.path.exists(path):
+                    os.remove(path)
+    return videos
+
+
+def make_tree(folder, depth=3, fanout=4, files=20, video_ratio=0.5):
+    """
+    folder tree of empty files for the scan benchmark, a share of them with video suffixes
+    :return: (number of files, number of video files)
+    """
+    count = 0
+    videos = 0
+    folders = [folder]
+    for level in range(depth):
+        children = []
+        for parent in folders:
+            for i in range(fanout):
+                child = os.path.join(parent, 'd%d_%d' % (level, i))
+                os.makedirs(child, exist_ok=True)
+                children.append(child)
+        folders = children
+    for parent in folders:
+        for i in range(files):
+            is_video = i < files * video_ratio
+            name = 'f%d%s' % (i, '.mp4' if is_video else '.txt')
+            open(os.path.join(parent, name), mode='wb').close()
+            count += 1
+            videos += is_video
+    return count, videos
@@ -0,0 +1,303 @@
+import os
+import sys
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import cv2
+from video_file import *
+from video_process import MediaFinder, VideoProcess
+from job_queue import JobQueue
+from benchmark.corpus import make_corpus, make_tree
+
+result_version = 1
+
+# the folder of video_player.py, the startup benchmark imports it in a fresh interpreter
+source_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# upper bounds in ms a run is checked against, first paint counts from the first import of video_player
+startup_targets = {'import_ms': 250, 'first_paint_ms': 750}
+
+_first_paint_script = '''
+import time
+import video_player
+player = video_player.VideoPlayer()
+player.window.refresh()
+print((time.perf_counter() - video_player._started) * 1000)
+'''
+
+
+def _metric(value, unit, better, target=None):
+    """
+    :param better: 'higher' or 'lower', which direction is an improvement when comparing runs
+    :param target: value the metric should not exceed, or fall below if higher is better
+    """
+    metric = {'value': value, 'unit': unit, 'better': better}
+    if target is not None:
+        metric['target'] = target
+    return metric
+
+
+def missed_target(metric):
+    if 'target' not in metric:
+        return False
+    if metric['better'] == 'higher':
+        return metric['value'] < metric['target']
+    return metric['value'] > metric['target']
+
+
+def _best(func, rounds):
+    """
+    :return: the shortest of rounds timed calls of func, the least disturbed by other work on the host
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _latencies(name, seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        name + '_p50': _metric(float(np.percentile(ms, 50)), 'ms', 'lower'),
+        name + '_p99': _metric(float(np.percentile(ms, 99)), 'ms', 'lower')
+    }
+
+
+def bench_scan(config):
+    root = 'tree'
+    if config['quick']:
+        total, videos = make_tree(root, depth=3, fanout=4, files=20)
+    else:
+        total, videos = make_tree(root, depth=3, fanout=6, files=50)
+    found = sum(1 for _ in MediaFinder(root).iter_files())
+    assert found == videos, 'found %d of %d videos' % (found, videos)
+    elapsed = _best(lambda: sum(1 for _ in MediaFinder(root).iter_files()), config['rounds'])
+    return {'scan_rate': _metric(total / elapsed, 'files/s', 'higher')}
+
+
+def bench_db(config):
+    count = 500 if config['quick'] else 5000
+    repo_file = 'db_bench.db'
+    repo = Repository(repo_file)
+    paths = [os.path.join('library', 'folder%d' % (i % 50), 'video%d.mp4' % i) for i in range(count)]
+    start = time.perf_counter()
+    for path in paths:
+        repo.insert(str(uuid.uuid1()), path)
+    insert = time.perf_counter() - start
+    lookup = _best(lambda: [repo.find_by_path(path) for path in paths], config['rounds'])
+    rows = len(repo.find_all())
+    find_all = _best(repo.find_all, config['rounds'])
+    jobs = JobQueue(repo_file)
+    put = _best(lambda: jobs.put(paths, reset=True), config['rounds'])
+    jobs.close()
+    return {
+        'db_insert': _metric(count / insert, 'rows/s', 'higher'),
+        'db_find_by_path': _metric(count / lookup, 'rows/s', 'higher'),
+        'db_find_all': _metric(rows / find_all, 'rows/s', 'higher'),
+        'db_job_put': _metric(count / put, 'rows/s', 'higher')
+    }
+
+
+def bench_index(config):
+    paths = [path for path, _, _, _ in config['corpus']]
+    jobs = JobQueue()
+    jobs.put(paths)
+    jobs.close()
+    processor = VideoProcess(workers=config['workers'], exit_when_idle=True, device_readers=0, read_ahead=False)
+    start = time.perf_counter()
+    processor.start()
+    processor.join()
+    elapsed = time.perf_counter() - start
+    thumbnails = 0
+    for path in paths:
+        video = VideoFile(path)
+        if video.load_cache(touch=False):
+            thumbnails += len(video.get_small_frames())
+    return {
+        'index_rate': _metric(len(paths) / elapsed, 'videos/s', 'higher'),
+        'index_thumbnails': _metric(thumbnails / elapsed, 'thumbnails/s', 'higher'),
+        'index_peak_frames': _metric(processor.metrics.snapshot()['peak_bytes_in_flight'] / 1024 / 1024, 'MB',
+                                     'lower')
+    }
+
+
+def bench_cache_load(config):
+    paths = [path for path, _, _, _ in config['corpus']]
+    seconds = []
+    for _ in range(config['rounds']):
+        for path in paths:
+            start = time.perf_counter()
+            video = VideoFile(path)
+            video.load_cache(touch=False)
+            seconds.append(time.perf_counter() - start)
+    return _latencies('cache_load', seconds)
+
+
+def bench_seek(config):
+    rng = np.random.default_rng(0)
+    seconds = []
+    for path, _, _, _ in config['corpus']:
+        video = VideoFile(path)
+        for pos in rng.uniform(1, 99, config['rounds'] * 2):
+            start = time.perf_counter()
+            video.grab_frame(float(pos))
+            seconds.append(time.perf_counter() - start)
+        video.close()
+    return _latencies('seek', seconds)
+
+
+def _python(args):
+    """
+    run a fresh interpreter on the sources from the current work dir
+    :return: the completed process, output captured as text
+    """
+    env = dict(os.environ, PYTHONPATH=source_root)
+    return subprocess.run([sys.executable] + args, env=env, capture_output=True, text=True)
+
+
+def import_profile(module='video_player'):
+    """
+    :return: list of (name, self ms, cumulative ms, depth) in import order, parsed from -X importtime
+    """
+    process = _python(['-X', 'importtime', '-c', 'import ' + module])
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(own) / 1000, int(cumulative) / 1000, depth))
+    return rows
+
+
+def bench_startup(config):
+    """
+    cold import of video_player with the time spent in each of its direct imports, and the time until the
+    window is painted where a display is available
+    """
+    best = None
+    for _ in range(config['rounds']):
+        rows = import_profile()
+        if best is None or rows[-1][2] < best[-1][2]:
+            best = rows
+    # video_player is reported last at depth 0, right after the imports below it
+    tree = []
+    for row in reversed(best[:-1]):
+        if row[3] == 0:
+            break
+        tree.insert(0, row)
+    metrics = {'import_ms': _metric(best[-1][2], 'ms', 'lower', startup_targets['import_ms'])}
+    for name, _, cumulative, depth in tree:
+        if depth == 1:
+            metrics['import_%s_ms' % name] = _metric(cumulative, 'ms', 'lower')
+    print('slowest imports:')
+    for name, own, _, _ in sorted(tree, key=lambda row: -row[1])[:10]:
+        print('  %-40s %8.1f ms' % (name, own))
+    for heavy in ['cv2', 'numpy']:
+        if heavy in [row[0] for row in tree]:
+            print('  warning: %s is imported at startup' % heavy)
+
+    seconds = []
+    for _ in range(config['rounds']):
+        process = _python(['-c', _first_paint_script])
+        if process.returncode != 0:
+            print('first paint skipped: %s' % process.stderr.strip().splitlines()[-1])
+            break
+        seconds.append(float(process.stdout.strip().splitlines()[-1]))
+    if len(seconds) > 0:
+        metrics['first_paint_ms'] = _metric(min(seconds), 'ms', 'lower', startup_targets['first_paint_ms'])
+    return metrics
+
+
+def _memory_peak():
+    """
+    :return: peak resident memory in MB, None where the resource module is missing
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+benchmarks = [bench_startup, bench_scan, bench_db, bench_index, bench_cache_load, bench_seek]
+
+
+def run(quick=False, workers=None, workdir=None, only=None):
+    """
+    generate the corpus in a scratch work dir and run the benchmarks in it
+    :param workdir: keep the corpus and caches in this folder instead of a temporary one
+    :param only: list of benchmark names, e.g. ['scan', 'seek'], all if None
+    :return: dict of the results, see compare for comparing two of them
+    """
+    scratch = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='video_previewer_bench_'))
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        start = time.perf_counter()
+        corpus = make_corpus('corpus', quick)
+        config = {
+            'quick': quick,
+            'workers': workers or os.cpu_count() or 1,
+            'rounds': 3 if quick else 10,
+            'corpus': corpus
+        }
+        print('generated %d videos in %.1fs' % (len(corpus), time.perf_counter() - start))
+        metrics = dict()
+        for bench in benchmarks:
+            name = bench.__name__[len('bench_'):]
+            if only is not None and name not in only:
+                continue
+            start = time.perf_counter()
+            metrics.update(bench(config))
+            print('%s done in %.1fs' % (name, time.perf_counter() - start), flush=True)
+        peak = _memory_peak()
+        if peak is not None:
+            metrics['memory_peak'] = _metric(peak, 'MB', 'lower')
+    finally:
+        os.chdir(cwd)
+        if scratch:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'version': result_version,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'config': {
+            'quick': quick,
+            'workers': config['workers'],
+            'rounds': config['rounds'],
+            'corpus': [{'codec': codec, 'size': list(size), 'frames': frames} for _, codec, size, frames in corpus]
+        },
+        'metrics': metrics
+    }
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    :param tolerance: relative change in the worse direction that still counts as noise
+    :return: list of (name, old value, new value, relative change, regressed) for metrics in both results
+    """
+    rows = []
+    for name, metric in new['metrics'].items():
+        if name not in old['metrics']:
+            continue
+        before = old['metrics'][name]['value']
+        after = metric['value']
+        change = (after - before) / before if before else 0.0
+        worse = -change if metric['better'] == 'higher' else change
+        rows.append((name, before, after, change, worse > tolerance))
+    return rows
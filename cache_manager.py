@@ -0,0 +1,134 @@
+import os
+import time
+from video_file import *
+from library import Library
+
+default_quota = 2 * 1024 * 1024 * 1024
+default_spare_score = 60
+
+
+class CacheManager:
+    """
+    Keeps the cache directory consistent with the repository and under a byte quota.
+    Cache files without a repository row are removed, rows without a cache file are reported,
+    and least recently used caches are evicted when the quota is exceeded. Videos with a score
+    of at least spare_score are never evicted.
+    """
+
+    def __init__(self, quota=None, spare_score=None, batch_size=200, pause=0.01):
+        repo = Repository(cache_repo)
+        if quota is None:
+            quota = repo.get_setting('cache_quota', default_quota)
+        if spare_score is None:
+            spare_score = repo.get_setting('cache_spare_score', default_spare_score)
+        self.quota = quota
+        self.spare_score = spare_score
+        self.batch_size = batch_size
+        self.pause = pause
+        self._is_stopped = False
+
+    def stop(self):
+        self._is_stopped = True
+
+    def _yield(self, count):
+        # give the CPU and the disk back to the UI and the video processor between batches
+        if count % self.batch_size == 0 and self.pause > 0:
+            time.sleep(self.pause)
+
+    def _scan_cache_dir(self):
+        """
+        :return: (dict uuid -> bytes of all its cache files, dict uuid -> names of its cache files)
+        """
+        sizes = {}
+        names = {}
+        if not os.path.isdir(cache_dir):
+            return sizes, names
+        count = 0
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                if self._is_stopped:
+                    break
+                if entry.is_file():
+                    # one file per thumbnail size
+                    uid = cache_uid(entry.name)
+                    sizes[uid] = sizes.get(uid, 0) + entry.stat().st_size
+                    names.setdefault(uid, []).append(entry.name)
+                count += 1
+                self._yield(count)
+        return sizes, names
+
+    def collect(self):
+        """
+        :return: dict with the collected statistics, 'missing' holds the paths of existing videos whose
+                 cache is gone
+        """
+        stats = {
+            'orphan_files': 0,
+            'evicted': 0,
+            'freed': 0,
+            'total': 0,
+            'missing': []
+        }
+        repo = Repository(cache_repo)
+        files, names = self._scan_cache_dir()
+        entries = repo.find_cache_entries()
+        known = set()
+        missing = []
+        count = 0
+        for uid, score, cache_size, last_access in entries:
+            if self._is_stopped:
+                return stats
+            known.add(uid)
+            if uid not in files:
+                # evicted caches are marked with a negative size and are not reported as missing
+                if cache_size > 0:
+                    repo.update_cache_info(uid, 0, last_access)
+                if cache_size >= 0 and (score is None or score >= 0):
+                    missing.append(uid)
+            elif files[uid] != cache_size:
+                # caches written before sizes were recorded
+                repo.update_cache_info(uid, files[uid], last_access)
+            count += 1
+            self._yield(count)
+
+        for uid, size in files.items():
+            if self._is_stopped:
+                return stats
+            if uid not in known:
+                print('remove orphan cache ' + uid)
+                for name in names[uid]:
+                    self._remove(name)
+                stats['orphan_files'] += len(names[uid])
+                stats['freed'] += size
+            count += 1
+            self._yield(count)
+
+        total = sum(size for uid, size in files.items() if uid in known)
+        for uid, score, _, last_access in entries:
+            if total <= self.quota or self._is_stopped:
+                break
+            if uid not in files or (score is not None and score >= self.spare_score):
+                continue
+            print('evict cache %s, last access %d' % (uid, last_access))
+            for name in names[uid]:
+                self._remove(name)
+            repo.update_cache_info(uid, -1, last_access)
+            total -= files[uid]
+            stats['evicted'] += 1
+            stats['freed'] += files[uid]
+            count += 1
+            self._yield(count)
+
+        stats['total'] = total
+        # videos of unmounted roots are not looked for
+        library = Library()
+        stats['missing'] = [path for path in repo.find_paths(missing)
+                            if not library.is_offline(path) and os.path.exists(path)]
+        return stats
+
+    @staticmethod
+    def _remove(name):
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError as e:
+            print('failed to remove cache %s: %s' % (name, e))
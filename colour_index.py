@@ -0,0 +1,94 @@
+import threading
+from video_file import *
+from utils import colour
+from utils.lazy import lazy_import
+np = lazy_import('numpy')
+
+colour_matrix_file = 'colour_index.npy'
+colour_uids_file = 'colour_index.json'
+
+
+class ColourIndex:
+    """
+    All colour signatures of the library in one contiguous uint8 matrix, persisted next to the repository.
+    The repository stays the source of truth, the matrix is rebuilt from it when its colour_generation,
+    counted up on every signature written or video removed, differs from the one the matrix was built at.
+    """
+
+    def __init__(self, matrix_file=colour_matrix_file, uids_file=colour_uids_file):
+        self.matrix_file = matrix_file
+        self.uids_file = uids_file
+        # set by load or refresh
+        self.matrix = None
+        self.uids = []
+        self.generation = None
+        self._rows = dict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.matrix_file) or not os.path.exists(self.uids_file):
+            return False
+        with open(self.uids_file, mode='r') as file:
+            saved = json.load(file)
+        # files saved before generations were recorded hold the list of uuids alone, they are rebuilt
+        if not isinstance(saved, dict):
+            return False
+        matrix = np.load(self.matrix_file)
+        if matrix.shape[0] != len(saved['uids']):
+            return False
+        self._set(matrix, saved['uids'], saved['generation'])
+        return True
+
+    def refresh(self, force=False):
+        """
+        rebuild and save the matrix if signatures were written or removed since it was built
+        """
+        with self._lock:
+            repo = Repository(cache_repo)
+            if self.generation is None:
+                self.load()
+            # read before the signatures, a change committed in between makes the next refresh rebuild again
+            generation = repo.get_generation('colour_generation')
+            if not force and generation == self.generation:
+                return len(self.uids)
+            rows = repo.find_colours()
+            uids = [uid for uid, _ in rows]
+            matrix = np.frombuffer(b''.join(blob for _, blob in rows), dtype=np.uint8).reshape(len(rows), -1)
+            self._save(matrix, uids, generation)
+            self._set(matrix, uids, generation)
+            return len(uids)
+
+    def _set(self, matrix, uids, generation):
+        self.matrix = matrix
+        self.uids = uids
+        self.generation = generation
+        self._rows = {uid: i for i, uid in enumerate(uids)}
+
+    def _save(self, matrix, uids, generation):
+        np.save(self.matrix_file + '.tmp.npy', matrix)
+        os.replace(self.matrix_file + '.tmp.npy', self.matrix_file)
+        with open(self.uids_file + '.tmp', mode='w') as file:
+            json.dump({'generation': generation, 'uids': uids}, file)
+        os.replace(self.uids_file + '.tmp', self.uids_file)
+
+    def query(self, uid, limit=100):
+        """
+        :return: list of (score, path) of the videos looking most like uid, best first
+        """
+        matrix, uids, rows = self.matrix, self.uids, self._rows
+        if uid not in rows:
+            return []
+        scores = colour.similarity(matrix, np.asarray(matrix[rows[uid]]))
+        scores[rows[uid]] = -1
+        limit = min(limit, len(uids) - 1)
+        if limit <= 0:
+            return []
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+        repo = Repository(cache_repo)
+        results = []
+        for i in best:
+            rcd = repo.find_by_uuid(uids[i])
+            if rcd is not None:
+                results.append((float(scores[i]), rcd['path']))
+        return results
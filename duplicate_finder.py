@@ -0,0 +1,93 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from video_file import *
+from utils.fingerprint import partial_hash, full_hash, partial_size
+
+
+class DuplicateFinder:
+    """
+    Finds files with identical content. Files are grouped by size first, then by a hash of their
+    first and last few MB, and only files that still collide are hashed completely. Hashes are
+    cached in the repository together with the size and mtime they were computed for.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+
+    def find(self, paths):
+        """
+        :param paths: list of file paths
+        :return: list of groups, each group is a list of paths with the same content
+        """
+        repo = Repository(cache_repo)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            stats = dict(zip(paths, executor.map(_stat, paths)))
+            cached = repo.find_hashes(paths)
+            records = {}
+            for path, stat in stats.items():
+                if stat is None:
+                    continue
+                size, mtime = stat
+                partial, full = None, None
+                if path in cached and cached[path][0] == size and cached[path][1] == mtime:
+                    partial, full = cached[path][2], cached[path][3]
+                records[path] = [size, mtime, partial, full]
+
+            by_size = _group(records, lambda path: records[path][0])
+            candidates = [path for size, group in by_size.items() if size > 0 and len(group) > 1 for path in group]
+            self._fill(executor, records, candidates, 2, partial_hash)
+
+            by_partial = _group(candidates, lambda path: (records[path][0], records[path][2]))
+            candidates = []
+            for (size, partial), group in by_partial.items():
+                if partial is None or len(group) < 2:
+                    continue
+                if size <= partial_size * 2:
+                    # the partial hash already covers the whole file
+                    for path in group:
+                        records[path][3] = partial
+                else:
+                    candidates += group
+            self._fill(executor, records, candidates, 3, full_hash)
+
+        repo.update_hashes([(path, size, mtime, partial, full)
+                            for path, (size, mtime, partial, full) in records.items()
+                            if path not in cached or cached[path] != (size, mtime, partial, full)])
+        by_full = _group([path for path in records if records[path][3] is not None],
+                         lambda path: records[path][3])
+        return [sorted(group) for group in by_full.values() if len(group) > 1]
+
+    @staticmethod
+    def _fill(executor, records, paths, index, func):
+        paths = [path for path in paths if records[path][index] is None]
+        for path, value in zip(paths, executor.map(_safe_call(func), paths)):
+            records[path][index] = value
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    except OSError:
+        return None
+
+
+def _safe_call(func):
+    def call(path):
+        try:
+            return func(path)
+        except OSError as e:
+            print('failed to hash %s: %s' % (path, e))
+            return None
+    return call
+
+
+def _group(keys, key_func):
+    groups = dict()
+    for key in keys:
+        group_key = key_func(key)
+        if group_key in groups:
+            groups[group_key].append(key)
+        else:
+            groups[group_key] = [key]
+    return groups
@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from video_file import *
+from library import Library
+
+default_max_age = 60
+
+
+def _check_folder(args):
+    """
+    :param args: (folder, paths in the folder)
+    :return: dict path -> whether it exists, from a single listing of the folder
+    """
+    folder, paths = args
+    try:
+        with os.scandir(folder) as entries:
+            names = set(os.path.normcase(entry.name) for entry in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return {path: False for path in paths}
+    except OSError:
+        # e.g. a folder that can be traversed but not listed
+        return {path: os.path.exists(path) for path in paths}
+    return {path: os.path.normcase(os.path.basename(path)) in names for path in paths}
+
+
+class ExistenceScanner:
+    """
+    Checks whether videos still exist with one scandir per folder instead of one stat per file, and
+    several folders at once, so a library on external or network drives costs a few round trips per
+    folder. The results are saved in the repository with the time of the check.
+    """
+
+    def __init__(self, workers=16, max_age=default_max_age):
+        """
+        :param max_age: seconds a saved result is trusted before the path is checked again
+        """
+        self.workers = workers
+        self.max_age = max_age
+
+    def check(self, paths, cancelled=None):
+        """
+        :param cancelled: polled between folders, the check stops early once it returns True
+        :return: dict path -> whether it exists, paths below offline library roots are left out
+        """
+        repo = Repository(cache_repo)
+        library = Library()
+        library.check()
+        now = time.time()
+        results = dict()
+        folders = dict()
+        for path, (exists, checked) in repo.find_existence(paths).items():
+            if now - checked <= self.max_age:
+                results[path] = exists
+        for path in paths:
+            if path not in results and not library.is_offline(path):
+                folders.setdefault(os.path.dirname(path), []).append(path)
+        checked = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for found in executor.map(_check_folder, folders.items()):
+                if cancelled is not None and cancelled():
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+                results.update(found)
+                checked += [(path, exists, now) for path, exists in found.items()]
+        repo.update_existence(checked)
+        return results
@@ -0,0 +1,85 @@
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from video_file import *
+from utils.face_detect import FaceDetect, default_params
+from utils.lazy import lazy_import
+np = lazy_import('numpy')
+
+
+def _detect_cache(args):
+    """
+    runs in a worker process, detects faces on every small frame of a cache file
+    :return: (uuid, list of (idx, boxes) or None if there is no cache, seconds spent in detection)
+    """
+    uid, params = args
+    cache_file = os.path.join(cache_dir, uid)
+    if not os.path.exists(cache_file):
+        return uid, None, 0.0
+    _, frames = read_cache(cache_file)
+    if frames is None:
+        return uid, None, 0.0
+    detector = FaceDetect(**params)
+    faces = []
+    elapsed = 0.0
+    for idx, frame in enumerate(frames):
+        img = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        start = time.perf_counter()
+        try:
+            boxes = detector.find(img)
+        except cv2.error as e:
+            print('failed to detect faces of %s: %s' % (uid, e))
+            return uid, None, elapsed
+        elapsed += time.perf_counter() - start
+        faces.append((idx, [list(box) for box in boxes]))
+    return uid, faces, elapsed
+
+
+class FaceIndexer(threading.Thread):
+    """
+    Optional indexing stage, runs the face detector over the cached small frames of every video that
+    has not been indexed yet in worker processes and stores the boxes in the repository.
+    """
+
+    def __init__(self, workers=None, on_done=None):
+        threading.Thread.__init__(self, name='face_indexer', daemon=True)
+        self.workers = workers
+        self.on_done = on_done
+        self._is_stopped = False
+
+    def run(self):
+        repo = Repository(cache_repo)
+        params = repo.get_setting('face_detect', default_params)
+        uids = repo.find_faces_pending()
+        stats = {
+            'videos': 0,
+            'frames': 0,
+            'with_faces': 0,
+            'seconds': 0.0
+        }
+        print('index faces of %d videos' % len(uids))
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            for uid, faces, elapsed in executor.map(_detect_cache, [(uid, params) for uid in uids], chunksize=8):
+                if self._is_stopped:
+                    break
+                if faces is None:
+                    continue
+                repo.update_faces(uid, faces)
+                stats['videos'] += 1
+                stats['frames'] += len(faces)
+                stats['seconds'] += elapsed
+                if any(len(boxes) > 0 for _, boxes in faces):
+                    stats['with_faces'] += 1
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if stats['frames'] > 0:
+            print('face detect %.2f ms per frame over %d frames' %
+                  (stats['seconds'] * 1000 / stats['frames'], stats['frames']))
+        if self.on_done is not None:
+            self.on_done(stats)
+
+    def stop(self):
+        self._is_stopped = True
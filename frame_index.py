@@ -0,0 +1,101 @@
+import threading
+from video_file import *
+from utils import phash
+from utils.lazy import lazy_import
+np = lazy_import('numpy')
+
+_popcount = None
+
+
+def _popcount_table():
+    """
+    :return: number of set bits of every byte value, built on first use so numpy loads only when needed
+    """
+    global _popcount
+    if _popcount is None:
+        _popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _popcount
+
+
+class FrameIndex:
+    """
+    In memory index over the hashes of all cached small frames, answers "which videos contain a frame
+    like this one" with one vectorised hamming distance scan. refresh picks up the videos indexed again or
+    removed since, tracked by the frame_hashes_generation the repository counts up on every change.
+    """
+
+    def __init__(self):
+        # arrays are created by the first refresh
+        self.hashes = None
+        self.videos = None
+        self.positions = None
+        self.uids = []
+        self.paths = []
+        self._video_index = dict()
+        # -1 loads the videos hashed before generations were recorded too
+        self._generation = -1
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        if self.hashes is None:
+            self.hashes = np.zeros(0, dtype=np.uint64)
+            self.videos = np.zeros(0, dtype=np.int32)
+            self.positions = np.zeros(0, dtype=np.float32)
+        repo = Repository(cache_repo)
+        generation = repo.get_generation('frame_hashes_generation')
+        if generation == self._generation:
+            return len(self.hashes)
+        # read after the generation, a change committed in between is loaded again by the next refresh
+        rows = repo.find_frame_hashes_since(self._generation)
+        self._generation = generation
+        current = set()
+        for uid, path, _ in repo.find_signatures():
+            current.add(uid)
+            if uid not in self._video_index:
+                self._video_index[uid] = len(self.uids)
+                self.uids.append(uid)
+                self.paths.append(path)
+            else:
+                self.paths[self._video_index[uid]] = path
+        rows = [row for row in rows if row[0] in current]
+        # the old hashes of videos indexed again and all hashes of removed videos are dropped
+        stale = {self._video_index[uid] for uid, _, _ in rows}
+        stale.update(i for i, uid in enumerate(self.uids) if uid not in current)
+        if len(stale) > 0 and len(self.videos) > 0:
+            keep = ~np.isin(self.videos, np.array(list(stale), dtype=np.int32))
+            self.hashes, self.videos, self.positions = self.hashes[keep], self.videos[keep], self.positions[keep]
+        self.hashes = np.concatenate([self.hashes, np.array([row[2] for row in rows], dtype=np.uint64)])
+        self.videos = np.concatenate([self.videos,
+                                      np.array([self._video_index[row[0]] for row in rows], dtype=np.int32)])
+        self.positions = np.concatenate([self.positions, np.array([row[1] for row in rows], dtype=np.float32)])
+        return len(self.hashes)
+
+    def query(self, frame, radius=12, limit=50, exclude=None):
+        """
+        :param frame: BGR image, e.g. VideoFile.get_cur_cv_frame()
+        :param exclude: uuid of a video to leave out of the results
+        :return: list of (distance, path, pos), the best matching frame of each video ordered by distance
+        """
+        with self._lock:
+            hashes, videos, positions = self.hashes, self.videos, self.positions
+        if hashes is None or len(hashes) == 0:
+            return []
+        h = np.uint64(phash.dhash(frame))
+        distances = _popcount_table()[(hashes ^ h).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        candidates = np.nonzero(distances <= radius)[0]
+        candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+        results = []
+        seen = set()
+        for i in candidates:
+            video = int(videos[i])
+            if video in seen or self.uids[video] == exclude:
+                continue
+            seen.add(video)
+            results.append((int(distances[i]), self.paths[video], float(positions[i])))
+            if len(results) >= limit:
+                break
+        return results
@@ -0,0 +1,118 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from video_file import Repository, cache_repo, _encode_path, _decode_path
+
+default_lease = 120
+default_max_attempts = 3
+
+
+class JobQueue:
+    """
+    Indexing jobs persisted in the jobs table of the repository, so a restart resumes the backlog.
+    A job is claimed by setting it running with a lease, the lease is extended by heartbeats while the
+    job is processed, and running jobs whose lease expired are claimed again, so several threads or
+    processes (also on other hosts sharing the repository file) can pull from the same queue. Leases
+    use the wall clock, the hosts sharing a queue should keep their clocks in sync.
+    """
+
+    def __init__(self, repo_file=cache_repo, owner=None, lease=default_lease, max_attempts=default_max_attempts):
+        Repository(repo_file)
+        self.repo_file = repo_file
+        self.owner = owner or '%s:%d:%d' % (socket.gethostname(), os.getpid(), threading.get_ident())
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(repo_file, timeout=30, isolation_level=None)
+
+    def put(self, paths, reset=False):
+        """
+        :param reset: queue paths again whose job is done or failed, otherwise they are left alone
+        :return: number of jobs that became pending
+        """
+        now = time.time()
+        values = [(_encode_path(path), now) for path in paths]
+        cursor = self.conn.cursor()
+        cursor.execute('begin immediate')
+        before = self.conn.total_changes
+        cursor.executemany("insert or ignore into jobs(path, state, created) values (?, 'pending', ?)", values)
+        if reset:
+            cursor.executemany("update jobs set state='pending', attempts=0, error=null, created=? "
+                               "where path=? and state in ('done', 'failed')",
+                               [(created, path) for path, created in values])
+        cursor.execute('commit')
+        cursor.close()
+        return self.conn.total_changes - before
+
+    def claim(self, count=1):
+        """
+        running jobs whose lease expired after max_attempts claims fail instead, their worker kept crashing
+        or hanging on them
+        :return: list of (job id, path) now running for this owner
+        """
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.execute('begin immediate')
+        cursor.execute("update jobs set state='failed', lease_expires=null, error='lease expired' "
+                       "where state='running' and lease_expires < ? and attempts >= ?", (now, self.max_attempts))
+        cursor.execute("select id, path from jobs where state='pending' or (state='running' and lease_expires < ?) "
+                       "order by id limit ?", (now, count))
+        jobs = cursor.fetchall()
+        cursor.executemany("update jobs set state='running', owner=?, lease_expires=?, heartbeat=?, "
+                           "attempts=attempts+1 where id=?",
+                           [(self.owner, now + self.lease, now, job_id) for job_id, _ in jobs])
+        cursor.execute('commit')
+        cursor.close()
+        return [(job_id, _decode_path(path)) for job_id, path in jobs]
+
+    def heartbeat_all(self, job_ids):
+        now = time.time()
+        self.conn.executemany("update jobs set lease_expires=?, heartbeat=? where id=? and owner=? "
+                              "and state='running'",
+                              [(now + self.lease, now, job_id, self.owner) for job_id in job_ids])
+
+    def complete(self, job_id, ok, error=None):
+        """
+        failed jobs go back to pending until they failed max_attempts times
+        :return: the new state of the job
+        """
+        if ok:
+            self.conn.execute("update jobs set state='done', lease_expires=null, error=null where id=? and owner=?",
+                              (job_id, self.owner))
+        else:
+            self.conn.execute("update jobs set state=case when attempts >= ? then 'failed' else 'pending' end, "
+                              "lease_expires=null, error=? where id=? and owner=?",
+                              (self.max_attempts, error, job_id, self.owner))
+        cursor = self.conn.cursor()
+        cursor.execute('select state from jobs where id=?', (job_id,))
+        value = cursor.fetchone()
+        cursor.close()
+        return value[0] if value is not None else None
+
+    def park(self, job_id):
+        """
+        set aside a job whose library root is offline, without counting the claim as an attempt
+        """
+        self.conn.execute("update jobs set state='offline', lease_expires=null, attempts=attempts-1 "
+                          "where id=? and owner=?", (job_id, self.owner))
+
+    def unpark(self):
+        """
+        queue the parked jobs again once a root came back, the ones still offline are parked again
+        :return: number of jobs that became pending
+        """
+        before = self.conn.total_changes
+        self.conn.execute("update jobs set state='pending' where state='offline'")
+        return self.conn.total_changes - before
+
+    def counts(self):
+        cursor = self.conn.cursor()
+        cursor.execute('select state, count(*) from jobs group by state')
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0, 'offline': 0}
+        counts.update(dict(cursor.fetchall()))
+        cursor.close()
+        return counts
+
+    def close(self):
+        self.conn.close()
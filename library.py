@@ -0,0 +1,243 @@
+import fnmatch
+import threading
+from video_file import *
+from job_queue import JobQueue
+
+default_suffixes = ['.mp4',
+                    '.avi',
+                    '.wmv',
+                    '.rmvb',
+                    '.mkv',
+                    '.TS',
+                    '.ts'
+                    ]
+
+default_check_interval = 60
+put_batch_size = 500
+
+default_root = {
+    'name': None,
+    'path': None,
+    # None for default_suffixes
+    'suffixes': None,
+    # glob patterns of files and folders to skip, matched against the name and the path below the root
+    'excludes': [],
+    # seconds between scheduled scans, None to scan only when asked
+    'schedule': None,
+    # concurrent decodes of the videos of the root, None for the limits of the pipeline alone
+    'workers': None,
+    # prefetch files before decoding, None for the read_ahead setting
+    'read_ahead': None,
+    # the drive was not mounted at the last check
+    'offline': False,
+    'last_scan': None,
+    # the deepest mount point above the root seen while it was online, see is_mounted
+    'mount_point': None
+}
+
+
+class MediaFinder:
+    def __init__(self, folder, suffixes=None, excludes=None):
+        if suffixes is None:
+            suffixes = default_suffixes
+        self.root = folder
+        self.suffixes = suffixes
+        self.excludes = excludes or []
+        self.files = []
+
+    def find_all(self):
+        self.files += self.iter_files()
+        return self.files
+
+    def matches(self, file):
+        return any(file.endswith(suffix) for suffix in self.suffixes)
+
+    def is_excluded(self, path):
+        relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative, pattern) for pattern in self.excludes)
+
+    def iter_files(self):
+        for root, dirs, files in os.walk(self.root):
+            if len(self.excludes) > 0:
+                dirs[:] = [folder for folder in dirs if not self.is_excluded(os.path.join(root, folder))]
+
+            for file in files:
+                if self.matches(file):
+                    path = os.path.join(root, file)
+                    path = os.path.normpath(path)
+                    if len(self.excludes) > 0 and self.is_excluded(path):
+                        continue
+                    yield path
+
+
+def new_root(name, path, **options):
+    root = dict(default_root)
+    root.update(options)
+    root['name'] = name
+    root['path'] = os.path.normpath(os.path.abspath(path))
+    if os.path.isdir(root['path']):
+        root['mount_point'] = mount_point(root['path'])
+    return root
+
+
+def mount_point(path):
+    """
+    :return: the closest folder at or above path that is a mount point
+    """
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def is_mounted(path, mount=None):
+    """
+    an unmounted drive either vanishes or leaves its mount point behind as an ordinary, usually empty
+    folder. An empty root that is still on its drive is mounted
+    :param mount: the mount point recorded for the root while it was online
+    """
+    if not os.path.isdir(path):
+        return False
+    return mount is None or os.path.ismount(mount)
+
+
+class Library:
+    """
+    The named library roots of the repository. Each root has its own suffixes, excludes, scan schedule
+    and limits, and is marked offline while its drive is not mounted, so the videos below it are not
+    stat'ed one by one or indexed into failures. Jobs of offline roots are parked until the root is back.
+    """
+
+    def __init__(self, repo_file=cache_repo):
+        self.repo_file = repo_file
+        self.roots = []
+        self.reload()
+
+    def reload(self):
+        # the deepest root first, so root_of finds the closest one for nested roots
+        self.roots = sorted(Repository(self.repo_file).find_roots(), key=lambda root: -len(root['path']))
+
+    def find(self, name):
+        for root in self.roots:
+            if root['name'] == name:
+                return root
+        return None
+
+    def root_of(self, path):
+        for root in self.roots:
+            if path == root['path'] or path.startswith(os.path.join(root['path'], '')):
+                return root
+        return None
+
+    def is_offline(self, path):
+        root = self.root_of(path)
+        return root is not None and root['offline']
+
+    def finder(self, root):
+        return MediaFinder(root['path'], root['suffixes'], root['excludes'])
+
+    def check(self):
+        """
+        look whether the roots are mounted and save the changes
+        :return: names of the roots that came back online, their parked jobs are pending again
+        """
+        repo = Repository(self.repo_file)
+        back = []
+        for root in self.roots:
+            offline = not is_mounted(root['path'], root['mount_point'])
+            if not offline:
+                self._update_mount_point(repo, root)
+            if offline == root['offline']:
+                continue
+            print('library root %s is %s' % (root['name'], 'offline' if offline else 'online'))
+            root['offline'] = offline
+            repo.update_root_state(root['name'], offline=offline)
+            if not offline:
+                back.append(root['name'])
+        if len(back) > 0:
+            jobs = JobQueue(self.repo_file)
+            jobs.unpark()
+            jobs.close()
+        return back
+
+    @staticmethod
+    def _update_mount_point(repo, root):
+        # a root added while its drive was not mounted first sees the mount point of the folder below it
+        current = mount_point(root['path'])
+        if root['mount_point'] is None or len(current) > len(root['mount_point']):
+            root['mount_point'] = current
+            repo.update_root_state(root['name'], mount_point=current)
+
+    def due(self, now=None):
+        """
+        :return: online roots whose scheduled scan is due
+        """
+        now = now or time.time()
+        return [root for root in self.roots if not root['offline'] and root['schedule'] is not None and
+                (root['last_scan'] is None or now - root['last_scan'] >= root['schedule'])]
+
+    def scan(self, root, jobs):
+        """
+        queue the videos of a root while walking it
+        :return: number of videos found, None if the root is offline
+        """
+        if not is_mounted(root['path'], root['mount_point']):
+            if not root['offline']:
+                root['offline'] = True
+                Repository(self.repo_file).update_root_state(root['name'], offline=True)
+            return None
+        found = 0
+        batch = []
+        for path in self.finder(root).iter_files():
+            batch.append(path)
+            if len(batch) >= put_batch_size:
+                jobs.put(batch)
+                found += len(batch)
+                batch = []
+        jobs.put(batch)
+        found += len(batch)
+        root['last_scan'] = time.time()
+        Repository(self.repo_file).update_root_state(root['name'], last_scan=root['last_scan'])
+        return found
+
+
+class LibraryScheduler(threading.Thread):
+    """
+    Checks every interval which roots are mounted and scans the ones whose schedule is due.
+    """
+
+    def __init__(self, interval=default_check_interval, on_scan=None):
+        """
+        :param on_scan: called with (root name, number of videos found) after each scan
+        """
+        threading.Thread.__init__(self, name='library_scheduler', daemon=True)
+        self.interval = interval
+        self.on_scan = on_scan
+        self._is_stopped = False
+        self._wakeup = threading.Event()
+
+    def run(self):
+        library = Library()
+        jobs = JobQueue()
+        while not self._is_stopped:
+            library.reload()
+            library.check()
+            for root in library.due():
+                if self._is_stopped:
+                    break
+                found = library.scan(root, jobs)
+                if found is None:
+                    continue
+                print('scanned library root %s, %d videos' % (root['name'], found))
+                if self.on_scan is not None:
+                    self.on_scan(root['name'], found)
+            self._wakeup.wait(self.interval)
+        jobs.close()
+
+    def stop(self):
+        self._is_stopped = True
+        self._wakeup.set()
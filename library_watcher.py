@@ -0,0 +1,386 @@
+import sys
+import sqlite3
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from collections import OrderedDict
+from video_file import *
+from video_process import MediaFinder
+from job_queue import JobQueue
+
+default_debounce = 2.0
+default_poll_interval = 30.0
+put_batch_size = 500
+
+# inotify(7) event masks
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+_watch_mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+_event_header = struct.Struct('iIII')
+
+# a moved-from event whose moved-to did not arrive within this many seconds left the watched roots
+_move_timeout = 0.5
+
+
+class _Inotify:
+    """
+    Recursive inotify watch over the roots. Events are (kind, path, dest, is_dir) with kind 'changed',
+    'found', 'deleted' or 'moved', dest is only set for moves. Found videos were already in a folder
+    that appeared, they are queued without indexing them again if they are known. Raises OSError if
+    inotify is missing or the watch limit is reached, the caller falls back to polling.
+    """
+
+    def __init__(self, roots, finder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.finder = finder
+        self.folders = dict()
+        # cookie -> (path, is_dir, time) of moves waiting for their moved-to half
+        self._moves = OrderedDict()
+        # set when the kernel queue overflowed and events were lost
+        self.overflowed = False
+        try:
+            for root in roots:
+                self._watch_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _watch(self, folder):
+        wd = self._add_watch(self.fd, os.fsencode(folder), _watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'inotify watch limit reached, see fs.inotify.max_user_watches')
+            # the folder vanished or can not be read, it is simply not watched
+            return
+        self.folders[wd] = folder
+
+    def _watch_tree(self, folder):
+        for root, dirs, files in os.walk(folder):
+            self._watch(os.path.normpath(root))
+
+    def _scan(self, folder):
+        """
+        watch a folder that appeared and report the videos already in it, they may predate the watch
+        """
+        self._watch_tree(folder)
+        return [('found', path, None, False) for path in MediaFinder(folder, self.finder.suffixes).iter_files()]
+
+    def _moved_folder(self, src, dst):
+        """
+        :param dst: new path of the folder, None if it left the roots and is no longer watched
+        """
+        for wd, folder in list(self.folders.items()):
+            if folder == src or folder.startswith(os.path.join(src, '')):
+                if dst is None:
+                    del self.folders[wd]
+                else:
+                    self.folders[wd] = dst + folder[len(src):]
+
+    def read(self, timeout):
+        """
+        :return: list of events, empty after timeout seconds without any
+        """
+        events = []
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            data = os.read(self.fd, 1024 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events += self._translate(wd, mask, cookie, name)
+        now = time.time()
+        while len(self._moves) > 0:
+            cookie, (path, is_dir, moved) = next(iter(self._moves.items()))
+            if now - moved < _move_timeout:
+                break
+            del self._moves[cookie]
+            if is_dir:
+                self._moved_folder(path, None)
+            if is_dir or self.finder.matches(os.path.basename(path)):
+                events.append(('deleted', path, None, is_dir))
+        return events
+
+    def _translate(self, wd, mask, cookie, name):
+        if mask & _IN_Q_OVERFLOW:
+            self.overflowed = True
+            return []
+        if mask & _IN_IGNORED:
+            self.folders.pop(wd, None)
+            return []
+        if wd not in self.folders:
+            return []
+        path = os.path.join(self.folders[wd], name)
+        is_dir = bool(mask & _IN_ISDIR)
+        if not is_dir and not self.finder.matches(name) and not mask & _IN_MOVED_FROM:
+            return []
+        if mask & _IN_MOVED_FROM:
+            self._moves[cookie] = (path, is_dir, time.time())
+        elif mask & _IN_MOVED_TO:
+            src = self._moves.pop(cookie, None)
+            if src is None:
+                # moved in from outside the roots
+                return self._scan(path) if is_dir else [('changed', path, None, False)]
+            if is_dir:
+                self._moved_folder(src[0], path)
+            elif not self.finder.matches(os.path.basename(src[0])):
+                # e.g. a download renamed from its temporary name when complete
+                return [('changed', path, None, False)]
+            return [('moved', src[0], path, is_dir)]
+        elif mask & _IN_CREATE:
+            return self._scan(path) if is_dir else [('changed', path, None, False)]
+        elif mask & (_IN_MODIFY | _IN_CLOSE_WRITE):
+            # every write of a file still being copied starts its debounce over
+            return [('changed', path, None, False)]
+        elif mask & _IN_DELETE:
+            return [('deleted', path, None, is_dir)]
+        return []
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    """
+    Fallback without inotify, walks the roots every interval and compares size and mtime with the
+    last walk. A new or modified file is only reported once it stayed the same over a whole interval,
+    so files still being copied are not indexed half written. A file that vanished while one of the
+    same size and mtime appeared is reported as moved.
+    """
+
+    def __init__(self, roots, finder, interval):
+        self.roots = roots
+        self.finder = finder
+        self.interval = interval
+        self.overflowed = False
+        self._files = self._walk()
+        self._unsettled = set()
+        self._last = time.time()
+
+    def _walk(self):
+        files = dict()
+        for root in self.roots:
+            for path in MediaFinder(root, self.finder.suffixes).iter_files():
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def read(self, timeout):
+        wait = self._last + self.interval - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            return []
+        self._last = time.time()
+        files = self._walk()
+        events = []
+        gone = {stat: path for path, stat in self._files.items() if path not in files}
+        for path, stat in files.items():
+            before = self._files.get(path)
+            if before is None and stat in gone:
+                events.append(('moved', gone.pop(stat), path, False))
+            elif before != stat:
+                self._unsettled.add(path)
+            elif path in self._unsettled:
+                self._unsettled.discard(path)
+                events.append(('changed', path, None, False))
+        for path in gone.values():
+            self._unsettled.discard(path)
+            events.append(('deleted', path, None, False))
+        self._files = files
+        return events
+
+    def close(self):
+        pass
+
+
+class _Pending:
+    """
+    Coalesces events per path until the path was quiet for the debounce time, so a file written in many
+    steps or touched by several events is handled once.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # path -> [kind, is_dir, time of the last event]
+        self.changes = OrderedDict()
+        self.moves = []
+
+    def add(self, kind, path, dest, is_dir):
+        now = self.clock()
+        if kind == 'moved':
+            change = self.changes.pop(path, None)
+            # the destination is replaced, whatever happened to it before no longer matters
+            self.changes.pop(dest, None)
+            self.moves.append((path, dest, is_dir))
+            if change is not None and change[0] == 'changed':
+                self.changes[dest] = ['changed', is_dir, now]
+            return
+        change = self.changes.pop(path, None)
+        if kind == 'found' and change is not None and change[0] == 'changed':
+            kind = 'changed'
+        self.changes[path] = [kind, is_dir, now]
+
+    def take(self, debounce):
+        """
+        :return: (moves, list of (kind, path, is_dir) quiet for debounce seconds), both removed
+        """
+        moves = self.moves
+        self.moves = []
+        now = self.clock()
+        ready = []
+        for path, (kind, is_dir, last) in list(self.changes.items()):
+            if now - last >= debounce:
+                del self.changes[path]
+                ready.append((kind, path, is_dir))
+        return moves, ready
+
+    def restore(self, taken):
+        """
+        put back what take returned, e.g. when the repository was locked, it is tried again after debounce
+        """
+        moves, ready = taken
+        self.moves = moves + self.moves
+        now = self.clock()
+        for kind, path, is_dir in ready:
+            if path not in self.changes:
+                self.changes[path] = [kind, is_dir, now]
+
+    def __len__(self):
+        return len(self.changes) + len(self.moves)
+
+
+class LibraryWatcher(threading.Thread):
+    """
+    Optional watch over library folders, feeds new and modified videos into the job queue, marks deleted
+    ones as missing and moves renamed ones along with their caches. Uses inotify where available and
+    falls back to walking the folders every poll_interval seconds. Bursts, e.g. a copy of thousands of
+    files, are coalesced per path and queued in batches once the files stopped changing.
+    """
+
+    def __init__(self, roots, debounce=default_debounce, poll_interval=default_poll_interval, polling=False,
+                 suffixes=None, on_change=None):
+        """
+        :param polling: walk the folders even if inotify is available, e.g. for network shares
+        :param on_change: called with a dict of the counts of queued, deleted and moved videos after each batch
+        """
+        threading.Thread.__init__(self, name='library_watcher', daemon=True)
+        self.roots = [os.path.normpath(os.path.abspath(root)) for root in roots]
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.polling = polling
+        self.finder = MediaFinder(None, suffixes)
+        self.on_change = on_change
+        self._is_stopped = False
+
+    def _open(self):
+        if not self.polling and sys.platform.startswith('linux'):
+            try:
+                return _Inotify(self.roots, self.finder)
+            except (OSError, AttributeError) as e:
+                print('inotify unavailable, polling every %ds: %s' % (self.poll_interval, e))
+        return _Poller(self.roots, self.finder, self.poll_interval)
+
+    def run(self):
+        source = self._open()
+        jobs = JobQueue()
+        repo = Repository(cache_repo)
+        pending = _Pending()
+        try:
+            while not self._is_stopped:
+                for kind, path, dest, is_dir in source.read(min(self.debounce, 1.0)):
+                    pending.add(kind, path, dest, is_dir)
+                if source.overflowed:
+                    source.overflowed = False
+                    print('watch events were lost, scanning %d folders again' % len(self.roots))
+                    for root in self.roots:
+                        for path in MediaFinder(root, self.finder.suffixes).iter_files():
+                            pending.add('found', path, None, False)
+                if len(pending) > 0:
+                    taken = pending.take(self.debounce)
+                    try:
+                        self._apply(taken, repo, jobs)
+                    except sqlite3.OperationalError as e:
+                        # e.g. the database is locked by an indexer, the batch waits for the next round
+                        print('failed to queue library changes, retrying: %s' % e)
+                        pending.restore(taken)
+                    except Exception as e:
+                        print('failed to queue library changes: %s' % e)
+        finally:
+            source.close()
+            jobs.close()
+
+    def _apply(self, taken, repo, jobs):
+        moves, ready = taken
+        stats = {'queued': 0, 'deleted': 0, 'moved': 0}
+        # queued with reset, the probe decodes videos whose content changed again
+        changed = []
+        # queued without reset, known videos are left alone
+        found = []
+        for src, dst, is_dir in moves:
+            if is_dir:
+                for uid, path in repo.find_under(src):
+                    moved = dst + path[len(src):]
+                    if repo.find_by_path(moved) is None:
+                        repo.update_path(uid, moved)
+                        stats['moved'] += 1
+                    else:
+                        # the destination was indexed already, e.g. merged into an existing folder
+                        repo.update_existence([(path, False, time.time())])
+                continue
+            rcd = repo.find_by_path(src)
+            if rcd is not None and repo.find_by_path(dst) is None:
+                repo.update_path(rcd['uuid'], dst)
+                stats['moved'] += 1
+            elif self.finder.matches(dst):
+                changed.append(dst)
+        now = time.time()
+        deleted = []
+        for kind, path, is_dir in ready:
+            if kind == 'changed':
+                changed.append(path)
+            elif kind == 'found':
+                found.append(path)
+            elif is_dir:
+                deleted += [(other, False, now) for _, other in repo.find_under(path)]
+            else:
+                deleted.append((path, False, now))
+        if len(deleted) > 0:
+            repo.update_existence(deleted)
+            stats['deleted'] = len(deleted)
+        for paths, reset in [(changed, True), (found, False)]:
+            for i in range(0, len(paths), put_batch_size):
+                batch = paths[i:i + put_batch_size]
+                # a video deleted and copied back exists again
+                repo.update_existence([(path, True, now) for path in batch])
+                stats['queued'] += jobs.put(batch, reset)
+        if any(stats.values()):
+            print('library changed: %d queued, %d deleted, %d moved' % (stats['queued'], stats['deleted'],
+                                                                        stats['moved']))
+            if self.on_change is not None:
+                self.on_change(stats)
+
+    def stop(self):
+        self._is_stopped = True
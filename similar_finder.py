@@ -0,0 +1,63 @@
+from video_file import *
+from utils import phash
+from utils.mih import MultiIndexHash
+
+
+class SimilarFinder:
+    """
+    Groups visually similar videos, e.g. re-encodes or different resolutions of the same video.
+    Candidates come from a multi-index hash over the per video signatures, a candidate is accepted
+    when at least half of its frame hashes are within frame_radius of the frame at the same position.
+    """
+
+    def __init__(self, radius=8, frame_radius=10):
+        self.radius = radius
+        self.frame_radius = frame_radius
+
+    def find(self, paths):
+        """
+        :param paths: list of file paths
+        :return: list of groups, each group is a list of similar paths
+        """
+        repo = Repository(cache_repo)
+        wanted = set(paths)
+        index = MultiIndexHash()
+        for uid, path, signature in repo.find_signatures():
+            if path in wanted:
+                index.add(signature, (uid, path))
+
+        parents = dict()
+        frame_hashes = dict()
+
+        def root(key):
+            while parents.get(key, key) != key:
+                key = parents[key]
+            return key
+
+        for signature, (uid, path) in index.items:
+            for d, _, (other_uid, other_path) in index.find(signature, self.radius):
+                if other_uid == uid or root(uid) == root(other_uid):
+                    continue
+                if self._is_similar(repo, frame_hashes, uid, other_uid):
+                    parents[root(other_uid)] = root(uid)
+
+        groups = dict()
+        for signature, (uid, path) in index.items:
+            key = root(uid)
+            if key in groups:
+                groups[key].append(path)
+            else:
+                groups[key] = [path]
+        return [sorted(group) for group in groups.values() if len(group) > 1]
+
+    def _is_similar(self, repo, frame_hashes, uid, other_uid):
+        for key in (uid, other_uid):
+            if key not in frame_hashes:
+                frame_hashes[key] = [h for _, _, h in repo.find_frame_hashes(key)]
+        hashes = frame_hashes[uid]
+        others = frame_hashes[other_uid]
+        count = min(len(hashes), len(others))
+        if count == 0:
+            return False
+        matched = sum(1 for a, b in zip(hashes, others) if phash.hamming(a, b) <= self.frame_radius)
+        return matched * 2 >= count
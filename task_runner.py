@@ -0,0 +1,112 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+task_done_event = 'task_done'
+
+
+class _Task:
+    def __init__(self, runner, channel, generation):
+        self.runner = runner
+        self.channel = channel
+        self.generation = generation
+
+    def cancelled(self):
+        return self.runner._is_closed or self.runner._generations[self.channel] != self.generation
+
+    def post(self, event, result):
+        """
+        hand an intermediate result to the window, dropped like the final one once the task is superseded
+        """
+        if not self.cancelled():
+            self.runner.window.write_event_value(task_done_event, (self.channel, self.generation, event, result))
+
+
+class TaskRunner:
+    """
+    Runs blocking work of the window on worker threads and hands the results back to the event loop.
+    Tasks are submitted on a channel, a channel runs one task at a time and a new task supersedes the
+    ones before it: a superseded task is skipped if it did not start yet, can poll its cancelled flag
+    while it runs, and its result is dropped. A channel holds at most one waiting task, the latest, and
+    takes a worker only while it has work, so a burst on one channel never parks the workers of the others.
+    """
+
+    def __init__(self, window, workers=4):
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='window_task')
+        self._generations = dict()
+        # channel -> the latest task waiting for the running one of the channel to finish
+        self._waiting = dict()
+        # channels with a worker draining them
+        self._running = set()
+        # channel -> items of submit_batch not taken by a task yet
+        self._batches = dict()
+        self._lock = threading.Lock()
+        self._is_closed = False
+
+    def submit(self, channel, func, event, cancellable=False):
+        """
+        :param channel: name of the kind of work, e.g. 'video' or 'list'
+        :param func: the work, called with the task if cancellable, which tells if it was superseded and
+        can post intermediate results
+        :param event: window event the result is dispatched as
+        """
+        with self._lock:
+            generation = self._generations.get(channel, 0) + 1
+            self._generations[channel] = generation
+            # a task still waiting is superseded, it is simply replaced
+            self._waiting[channel] = (_Task(self, channel, generation), func, event, cancellable)
+            if channel in self._running:
+                return
+            self._running.add(channel)
+        self.executor.submit(self._drain, channel)
+
+    def submit_batch(self, channel, items, func, event):
+        """
+        like submit for work that must not be skipped, e.g. removals: the items are collected on the channel
+        and each task takes all of them, so a task replaced while waiting leaves its items to the next one
+        :param func: called with the list of items collected so far
+        """
+        with self._lock:
+            self._batches.setdefault(channel, []).extend(items)
+
+        def run():
+            with self._lock:
+                batch = self._batches.pop(channel, [])
+            return func(batch)
+
+        self.submit(channel, run, event)
+
+    def _drain(self, channel):
+        while True:
+            with self._lock:
+                waiting = self._waiting.pop(channel, None)
+                if waiting is None:
+                    self._running.discard(channel)
+                    return
+            task, func, event, cancellable = waiting
+            if task.cancelled():
+                continue
+            try:
+                result = func(task) if cancellable else func()
+            except Exception as e:
+                print('task %s failed: %s' % (channel, e))
+                continue
+            task.post(event, result)
+
+    def cancel(self, channel):
+        with self._lock:
+            self._generations[channel] = self._generations.get(channel, 0) + 1
+
+    def take(self, done):
+        """
+        :param done: value of a task_done event
+        :return: (event, result) to dispatch, None if the task was superseded after it finished
+        """
+        channel, generation, event, result = done
+        if self._generations.get(channel) != generation:
+            return None
+        return event, result
+
+    def close(self):
+        self._is_closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,16 +1,41 @@
 import unittest
 from video_file import *
+from utils.fingerprint import fingerprint
+from utils.mih import MultiIndexHash
+from job_queue import JobQueue
+from library_watcher import LibraryWatcher, _Pending
+from duplicate_finder import DuplicateFinder
+from utils import scene_select, phash
+from existence_scanner import ExistenceScanner
 import re
+import tempfile
+import numpy as np
+import cv2
 
 
-class VideoFileTest(unittest.TestCase):
+class TempDirTest(unittest.TestCase):
+    """
+    runs each test in a temporary folder, the repositories and caches it creates are removed with it
+    """
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._dir = tempfile.TemporaryDirectory()
+        os.chdir(self._dir.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._dir.cleanup()
+
+
+class VideoFileTest(TempDirTest):
     def test_load_cache(self):
         video = VideoFile(path='test.mp4')
         ret = video.load_cache()
         self.assertEqual(True, ret)
 
 
-class RepositoryTest(unittest.TestCase):
+class RepositoryTest(TempDirTest):
     def test_insert(self):
         repo = Repository('test.db')
         uid = str(uuid.uuid1())
@@ -31,6 +56,316 @@ class RepositoryTest(unittest.TestCase):
         values = repo.find_all()
         print(values)
 
+    def test_settings(self):
+        repo = Repository('test_settings.db')
+        repo.set_setting('cache_quota', 1024)
+        self.assertEqual(1024, repo.get_setting('cache_quota'))
+        self.assertEqual('x', repo.get_setting('not_exists', 'x'))
+
+    def test_find_page(self):
+        repo = Repository('test_pages.db')
+        for i in range(25):
+            repo.insert(str(uuid.uuid1()), 'video%02d' % i, '%d:x' % (i % 5))
+        paths = []
+        after = None
+        while True:
+            page = repo.find_page('size', True, after, limit=10)
+            if len(page) == 0:
+                break
+            paths += [path for _, path in page]
+            after = page[-1][0]
+        self.assertEqual(25, len(set(paths)))
+        self.assertEqual(['video24', 'video19'], paths[:2])
+
+    def test_find_under(self):
+        repo = Repository('test_under.db')
+        for path in ['lib/a/1.mp4', 'lib/a/b/2.mp4', 'lib/ab/3.mp4', 'lib/A/4.mp4']:
+            repo.insert(str(uuid.uuid1()), os.path.normpath(path))
+        paths = sorted(path for _, path in repo.find_under(os.path.normpath('lib/a')))
+        self.assertEqual([os.path.normpath('lib/a/1.mp4'), os.path.normpath('lib/a/b/2.mp4')], paths)
+
+    def test_frame_hashes_since(self):
+        repo = Repository('test_hashes.db')
+        for uid in ['a', 'b']:
+            repo.insert(uid, uid + '.mp4')
+            repo.update_signature(uid, 1, [(i, i, i) for i in range(12)])
+        generation = repo.get_generation('frame_hashes_generation')
+        # the hashes of a video indexed again are found even though their rowids are reused
+        repo.update_signature('b', 1, [(i, i, 100 + i) for i in range(12)])
+        rows = repo.find_frame_hashes_since(generation)
+        self.assertEqual([('b', 100 + i) for i in range(12)], [(uid, h) for uid, _, h in rows])
+        repo.delete('a')
+        self.assertEqual(generation + 2, repo.get_generation('frame_hashes_generation'))
+
+    def test_motion(self):
+        for i, motion in enumerate([5.0, 40.0, None]):
+            Repository('test.db').insert('v%d' % i, 'v%d.mp4' % i)
+            if motion is not None:
+                Repository('test.db').update_motion('v%d' % i, motion)
+        self.assertEqual(['v1.mp4'], [rcd['path'] for rcd in Repository('test.db').find_with_motion(10, 100)])
+
+    def test_clear_faces(self):
+        video = VideoFile(path='faces.mp4')
+        repo = Repository(cache_repo)
+        repo.update_faces(video.uid, [(0, [[1, 2, 3, 4]]), (1, [])])
+        self.assertNotIn(video.uid, repo.find_faces_pending())
+        # a new cache replaces the frames the faces were found in
+        video.save_cache()
+        self.assertIn(video.uid, repo.find_faces_pending())
+        self.assertEqual([], repo.find_with_faces())
+
+
+class ThumbnailTest(TempDirTest):
+    @staticmethod
+    def _frame(width, height, value):
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        frame[:, :width // 2] = value
+        return frame
+
+    @staticmethod
+    def _width(frame):
+        return cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR).shape[1]
+
+    def test_pyramid(self):
+        levels = thumbnail_pyramid(self._frame(480, 320, 255))
+        self.assertEqual({120: (80, 120), 240: (160, 240), 480: (320, 480)},
+                         {width: frame.shape[:2] for width, frame in levels.items()})
+        # the aspect ratio is kept and small frames are not scaled up
+        levels = thumbnail_pyramid(self._frame(200, 50, 255))
+        self.assertEqual({120: (30, 120), 240: (50, 200), 480: (50, 200)},
+                         {width: frame.shape[:2] for width, frame in levels.items()})
+
+    def test_thumbnails(self):
+        video = VideoFile(path='thumbnails.mp4')
+        for i in range(3):
+            video._add_frame(thumbnail_pyramid(self._frame(480, 320, 50 * (i + 1))))
+        video.encode_small_frames()
+        video.save_cache()
+        self.assertEqual(sorted([video.uid, video.uid + '@120', video.uid + '@480']), sorted(os.listdir(cache_dir)))
+
+        video = VideoFile(path='thumbnails.mp4')
+        self.assertTrue(video.load_cache())
+        self.assertIs(video.small_frames, video.get_thumbnails(240))
+        _, large = read_cache(os.path.join(cache_dir, video.uid + '@480'))
+        self.assertEqual(large, video.get_thumbnails(480))
+        # scaled down from the closest size at least as wide
+        self.assertEqual([300] * 3, [self._width(frame) for frame in video.get_thumbnails(300)])
+        self.assertEqual([100] * 3, [self._width(frame) for frame in video.get_thumbnails(100)])
+        # never scaled up when the larger sizes are missing
+        os.remove(os.path.join(cache_dir, video.uid + '@480'))
+        video.thumbnails.clear()
+        self.assertIs(video.small_frames, video.get_thumbnails(600))
+
+
+def _noise(seed, size=(480, 320)):
+    return np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+
+
+class SceneSelectTest(unittest.TestCase):
+    def test_select_distinct(self):
+        colours = [(0, 0, 255), (0, 255, 0), (255, 0, 0)]
+        frames = []
+        for colour in colours:
+            # a fade to black between the scenes
+            frames.append(np.zeros((40, 60, 3), dtype=np.uint8))
+            for i in range(5):
+                frame = np.full((40, 60, 3), colour, dtype=np.uint8)
+                frame[:, :10 * (i + 1)] = 128
+                frames.append(frame)
+        picked = scene_select.select_distinct(frames, 3)
+        self.assertEqual(3, len(picked))
+        self.assertEqual(picked, sorted(picked))
+        self.assertFalse(any(scene_select.is_blank(frames[i]) for i in picked))
+        # one frame of each scene
+        self.assertEqual([0, 1, 2], [(i - 1) // 6 for i in picked])
+        self.assertEqual([0, 1], scene_select.select_distinct(frames[:2], 3))
+
+    def test_activity(self):
+        still = [_noise(1, (64, 48))] * 3
+        self.assertEqual(0.0, scene_select.activity(still))
+        flashing = [np.zeros((48, 64, 3), dtype=np.uint8), np.full((48, 64, 3), 255, dtype=np.uint8)] * 2
+        self.assertAlmostEqual(100.0, scene_select.activity(flashing))
+        self.assertLess(scene_select.activity([_noise(1, (64, 48)), _noise(2, (64, 48))]), 100.0)
+        self.assertEqual(0.0, scene_select.activity(still[:1]))
+
+
+class _FakeScreenShot:
+    """
+    stands in for the decoder, noise at every position unless a frame is given for it
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def grab(self, pos, size):
+        return self.frames[pos] if pos in self.frames else _noise(pos, size)
+
+    def release(self):
+        pass
+
+
+class SamplingTest(TempDirTest):
+    def test_is_rejected(self):
+        frame = _noise(1, small_frame_size)
+        h = phash.dhash(frame)
+        self.assertFalse(VideoFile._is_rejected(frame, h, []))
+        self.assertTrue(VideoFile._is_rejected(frame, h, [h ^ 0b101]))
+        black = np.zeros_like(frame)
+        self.assertTrue(VideoFile._is_rejected(black, phash.dhash(black), []))
+
+    def test_fixed_frames(self):
+        black = np.zeros((320, 480, 3), dtype=np.uint8)
+        video = VideoFile(path='fixed.mp4')
+        # a black frame at 16% and a repeat of the first one at 24% are replaced by nearby ones
+        video.screenshot = _FakeScreenShot({16: black, 24: _noise(8)})
+        video._grab_fixed_frames()
+        self.assertEqual([8, 18, 26] + [8 * i for i in range(4, small_frame_count + 1)], video.positions)
+        self.assertEqual(small_frame_count, len(video.small_cv_frames))
+        # without extra seeks the frames are kept
+        video._clear_frames()
+        video.positions.clear()
+        video._grab_fixed_frames(retry_budget=0)
+        self.assertEqual(16, video.positions[1])
+
+
+class ExistenceScannerTest(TempDirTest):
+    def test_check(self):
+        os.makedirs('lib/a')
+        paths = [os.path.abspath(path) for path in ['lib/a/1.mp4', 'lib/a/2.mp4', 'lib/3.mp4', 'gone/4.mp4']]
+        for path in paths[:3]:
+            open(path, mode='w').close()
+        os.remove(paths[1])
+        repo = Repository(cache_repo)
+        for path in paths:
+            repo.insert(str(uuid.uuid4()), path)
+        expected = {paths[0]: True, paths[1]: False, paths[2]: True, paths[3]: False}
+        self.assertEqual(expected, ExistenceScanner().check(paths))
+        # results younger than max_age come from the repository
+        os.remove(paths[0])
+        self.assertTrue(ExistenceScanner().check(paths)[paths[0]])
+        self.assertFalse(ExistenceScanner(max_age=-1).check(paths)[paths[0]])
+
+
+class FingerprintTest(TempDirTest):
+    def test_fingerprint(self):
+        with open('fingerprint.bin', mode='wb') as file:
+            file.write(os.urandom(1024 * 1024))
+        fp = fingerprint('fingerprint.bin')
+        os.replace('fingerprint.bin', 'fingerprint_moved.bin')
+        self.assertEqual(fp, fingerprint('fingerprint_moved.bin'))
+        self.assertTrue(fp.startswith('1048576:'))
+        os.remove('fingerprint_moved.bin')
+
+
+class DuplicateFinderTest(TempDirTest):
+    def test_find(self):
+        contents = {'a.mp4': b'same content', 'copy of a.mp4': b'same content', 'b.mp4': b'same length!',
+                    'c.mp4': b'other', 'empty1.mp4': b'', 'empty2.mp4': b''}
+        for name, content in contents.items():
+            with open(name, mode='wb') as file:
+                file.write(content)
+        paths = sorted(os.path.abspath(name) for name in contents)
+        repo = Repository(cache_repo)
+        for path in paths:
+            repo.insert(str(uuid.uuid4()), path)
+        expected = [[os.path.abspath('a.mp4'), os.path.abspath('copy of a.mp4')]]
+        self.assertEqual(expected, DuplicateFinder().find(paths))
+        self.assertIsNotNone(repo.find_hashes([os.path.abspath('a.mp4')])[os.path.abspath('a.mp4')][3])
+        # a file changed since its hash was cached is hashed again
+        with open('b.mp4', mode='wb') as file:
+            file.write(b'same content')
+        os.utime('b.mp4', (0, 0))
+        self.assertEqual([sorted(expected[0] + [os.path.abspath('b.mp4')])], DuplicateFinder().find(paths))
+
+
+class MultiIndexHashTest(TempDirTest):
+    def test_find(self):
+        index = MultiIndexHash()
+        index.add(0x0123456789abcdef, 'a')
+        index.add(0x0123456789abcdef ^ 0b10110001, 'b')
+        index.add(0xfedcba9876543210, 'c')
+        results = index.find(0x0123456789abcdef, 8)
+        self.assertEqual([(0, 'a'), (4, 'b')], [(d, item) for d, _, item in results])
+
+
+class JobQueueTest(TempDirTest):
+    def test_lease(self):
+        crashed = JobQueue('test_jobs.db', owner='crashed', lease=0.1)
+        crashed.put(['a.mp4', 'b.mp4'])
+        self.assertEqual(['a.mp4'], [path for _, path in crashed.claim()])
+        time.sleep(0.2)
+        jobs = JobQueue('test_jobs.db', owner='worker')
+        claimed = jobs.claim(5)
+        self.assertEqual(['a.mp4', 'b.mp4'], [path for _, path in claimed])
+        self.assertEqual('done', jobs.complete(claimed[0][0], True))
+        self.assertEqual('pending', jobs.complete(claimed[1][0], False, 'error'))
+        self.assertEqual(0, jobs.put(['a.mp4']))
+        self.assertEqual({'pending': 1, 'running': 0, 'done': 1, 'failed': 0, 'offline': 0}, jobs.counts())
+        # a parked job is not claimed and its claim is not counted as an attempt
+        job_id, _ = jobs.claim()[0]
+        jobs.park(job_id)
+        self.assertEqual([], jobs.claim())
+        self.assertEqual(1, jobs.unpark())
+        self.assertEqual('pending', jobs.complete(jobs.claim()[0][0], False, 'error'))
+
+    def test_lease_attempts(self):
+        jobs = JobQueue('test_attempts.db', lease=0, max_attempts=2)
+        jobs.put(['a.mp4'])
+        # the worker hangs twice, the job is not handed out a third time
+        self.assertEqual(1, len(jobs.claim()))
+        time.sleep(0.01)
+        self.assertEqual(1, len(jobs.claim()))
+        time.sleep(0.01)
+        self.assertEqual([], jobs.claim())
+        self.assertEqual(1, jobs.counts()['failed'])
+
+
+class LibraryWatcherTest(TempDirTest):
+    def test_pending(self):
+        now = [0.0]
+        pending = _Pending(clock=lambda: now[0])
+        pending.add('changed', 'a.mp4', None, False)
+        now[0] = 1.5
+        # still being written, the debounce starts over
+        pending.add('changed', 'a.mp4', None, False)
+        pending.add('moved', 'b.mp4', 'c.mp4', False)
+        now[0] = 2.0
+        self.assertEqual(([('b.mp4', 'c.mp4', False)], []), pending.take(2))
+        now[0] = 3.5
+        taken = pending.take(2)
+        self.assertEqual(([], [('changed', 'a.mp4', False)]), taken)
+        self.assertEqual(0, len(pending))
+        pending.restore(taken)
+        self.assertEqual(([], []), pending.take(2))
+        now[0] = 5.5
+        self.assertEqual(([], [('changed', 'a.mp4', False)]), pending.take(2))
+        # a change of a file that is moved away follows it
+        pending.add('changed', 'd.mp4', None, False)
+        pending.add('moved', 'd.mp4', 'e.mp4', False)
+        now[0] = 8.0
+        self.assertEqual(([('d.mp4', 'e.mp4', False)], [('changed', 'e.mp4', False)]), pending.take(2))
+
+    def test_apply(self):
+        root = os.path.abspath('lib')
+        old, new, merged = [os.path.join(root, name) for name in ['old', 'new', 'merged']]
+        repo = Repository(cache_repo)
+        jobs = JobQueue(cache_repo)
+        for path in ['a.mp4', 'old/1.mp4', 'old/2.mp4', 'merged/1.mp4', 'new/3.mp4']:
+            repo.insert(path, os.path.join(root, path))
+        watcher = LibraryWatcher([root])
+        watcher._apply(([(os.path.join(root, 'a.mp4'), os.path.join(root, 'b.mp4'), False),
+                         (old, merged, True)], []), repo, jobs)
+        self.assertEqual('a.mp4', repo.find_by_path(os.path.join(root, 'b.mp4'))['uuid'])
+        self.assertEqual('old/2.mp4', repo.find_by_path(os.path.join(merged, '2.mp4'))['uuid'])
+        # merged into a folder already indexed, the record of the destination stays
+        self.assertEqual('merged/1.mp4', repo.find_by_path(os.path.join(merged, '1.mp4'))['uuid'])
+        self.assertFalse(repo.find_existence([os.path.join(old, '1.mp4')])[os.path.join(old, '1.mp4')][0])
+
+        watcher._apply(([], [('deleted', new, True), ('changed', os.path.join(root, 'c.mp4'), False)]), repo, jobs)
+        self.assertFalse(repo.find_existence([os.path.join(new, '3.mp4')])[os.path.join(new, '3.mp4')][0])
+        self.assertEqual([os.path.join(root, 'c.mp4')], [path for _, path in jobs.claim(5)])
+        jobs.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,29 @@
+from utils.lazy import lazy_import
+np = lazy_import('numpy')
+
+bins = 64
+
+
+def colour_signature(frames):
+    """
+    compact colour signature of a video, a bins per channel histogram over all frames. Each value is the
+    square root of the bin frequency quantised to uint8, so the dot product of two signatures
+    approximates the Bhattacharyya coefficient of the histograms.
+    :param frames: list of BGR images
+    :return: uint8 array of 3 * bins values, None if there are no frames
+    """
+    if len(frames) == 0:
+        return None
+    pixels = np.concatenate([frame.reshape(-1, 3) for frame in frames]) // (256 // bins)
+    hists = np.stack([np.bincount(pixels[:, c], minlength=bins) for c in range(3)]).astype(np.float64)
+    hists /= hists.sum(axis=1, keepdims=True)
+    return np.round(np.sqrt(hists).ravel() * 255).astype(np.uint8)
+
+
+def similarity(matrix, signature):
+    """
+    :param matrix: n x (3 * bins) uint8 signatures
+    :return: float array of n scores in 0-1, 1 for identical colour distributions
+    """
+    scores = matrix.astype(np.float32) @ signature.astype(np.float32)
+    return scores / (3 * 255 * 255)
@@ -0,0 +1,153 @@
+import os
+import threading
+from collections import deque
+
+network_fs_types = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', '9p', 'afs', 'ceph', 'glusterfs']
+read_ahead_size = 4 * 1024 * 1024
+
+_slow_devices = dict()
+
+
+def device_of(path):
+    """
+    :return: st_dev of the file system holding path, None if it can not be read
+    """
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def _mount_fs_types():
+    """
+    :return: dict 'major:minor' -> file system type from the mount table, empty if there is none
+    """
+    types = dict()
+    try:
+        with open('/proc/self/mountinfo', mode='r') as file:
+            for line in file:
+                fields = line.split()
+                if '-' in fields:
+                    types[fields[2]] = fields[fields.index('-') + 1]
+    except OSError:
+        pass
+    return types
+
+
+def _is_rotational(major, minor):
+    """
+    :return: True for spinning disks, None if unknown
+    """
+    block = os.path.realpath('/sys/dev/block/%d:%d' % (major, minor))
+    # a partition has no queue of its own, it belongs to the disk above it
+    for folder in (block, os.path.dirname(block)):
+        try:
+            with open(os.path.join(folder, 'queue', 'rotational'), mode='r') as file:
+                return file.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+
+def is_slow_device(device):
+    """
+    spinning disks and network shares lose throughput when several files are read at once, on systems
+    without a mount table every device counts as slow
+    """
+    if device not in _slow_devices:
+        if not hasattr(os, 'major'):
+            _slow_devices[device] = True
+            return True
+        major, minor = os.major(device), os.minor(device)
+        fs_type = _mount_fs_types().get('%d:%d' % (major, minor))
+        if fs_type is None:
+            slow = True
+        elif fs_type in network_fs_types:
+            slow = True
+        else:
+            slow = _is_rotational(major, minor) is True
+        _slow_devices[device] = slow
+    return _slow_devices[device]
+
+
+def read_ahead(path, size=read_ahead_size):
+    """
+    ask the kernel to prefetch the head and the tail of the file, where containers keep their index,
+    so the decoder starts without waiting for the disk. No effect where posix_fadvise is missing.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            length = os.fstat(fd).st_size
+            os.posix_fadvise(fd, 0, min(size, length), os.POSIX_FADV_WILLNEED)
+            if length > size:
+                os.posix_fadvise(fd, max(length - size, size), 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print('failed to read ahead %s: %s' % (path, e))
+
+
+class DeviceLimiter:
+    """
+    Caps the concurrent readers of each slow device. A task for a busy device is parked instead of
+    blocking its worker, and the workers reading that device run the parked tasks before they let
+    the device go, so the other workers keep serving the other devices.
+    """
+
+    def __init__(self, readers=2, max_parked=8):
+        """
+        :param readers: concurrent readers per slow device, None for no limit
+        :param max_parked: parked tasks over all devices before a worker waits for a free reader
+        """
+        self.readers = readers
+        self.max_parked = max_parked
+        self._active = dict()
+        self._parked = dict()
+        self._parked_count = 0
+        self._cond = threading.Condition()
+
+    def _limit(self, device, readers):
+        if readers is not None:
+            return readers
+        if self.readers is None or device is None or not is_slow_device(device):
+            return None
+        return self.readers
+
+    def acquire_or_park(self, device, task, readers=None):
+        """
+        :param readers: limit of this device instead of the one for slow devices, e.g. a library root
+        :return: True if the caller got a reader of the device, False if task was parked for later
+        """
+        limit = self._limit(device, readers)
+        if limit is None:
+            return True
+        with self._cond:
+            while True:
+                if self._active.get(device, 0) < limit:
+                    self._active[device] = self._active.get(device, 0) + 1
+                    return True
+                if self._parked_count < self.max_parked:
+                    self._parked.setdefault(device, deque()).append(task)
+                    self._parked_count += 1
+                    return False
+                self._cond.wait()
+
+    def next_or_release(self, device, readers=None):
+        """
+        :return: a parked task of the device to run with the reader still held, None once the reader is released
+        """
+        if self._limit(device, readers) is None:
+            return None
+        with self._cond:
+            parked = self._parked.get(device)
+            if parked:
+                self._parked_count -= 1
+                task = parked.popleft()
+            else:
+                self._active[device] -= 1
+                task = None
+            self._cond.notify_all()
+            return task
@@ -1,18 +1,62 @@
-import cv2
+import os
+from utils.lazy import lazy_import
+cv2 = lazy_import('cv2')
+
+default_params = {
+    'scale_factor': 1.1,
+    'min_neighbors': 5,
+    'min_size': 20,
+    'max_width': 480
+}
+
+
+cascade_name = 'haarcascade_frontalface_default.xml'
+
+
+def _cascade_file():
+    # the data folder next to the sources first, then the copy shipped with opencv-python
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', cascade_name)
+    if not os.path.exists(path) and hasattr(cv2, 'data'):
+        path = os.path.join(cv2.data.haarcascades, cascade_name)
+    return path
 
 
 class FaceDetect:
     face_cascade = None
 
-    def __init__(self):
+    def __init__(self, scale_factor=1.1, min_neighbors=5, min_size=20, max_width=None):
+        """
+        :param scale_factor: detectMultiScale scaleFactor
+        :param min_neighbors: detectMultiScale minNeighbors
+        :param min_size: smallest face in pixels of the downscaled image
+        :param max_width: images wider than this are downscaled before detection
+        """
         if FaceDetect.face_cascade is None:
             print('init CascadeClassifier')
-            FaceDetect.face_cascade = cv2.CascadeClassifier('data\\haarcascade_frontalface_default.xml')
+            FaceDetect.face_cascade = cv2.CascadeClassifier(_cascade_file())
+            if FaceDetect.face_cascade.empty():
+                print('failed to load %s' % _cascade_file())
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self.max_width = max_width
 
-    def detect(self, img):
+    def find(self, img):
+        """
+        :return: list of (x, y, w, h) in the coordinates of img
+        """
         img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = FaceDetect.face_cascade.detectMultiScale(img_gray, 1.1, 5)
+        factor = 1.0
+        if self.max_width and img_gray.shape[1] > self.max_width:
+            factor = self.max_width / img_gray.shape[1]
+            img_gray = cv2.resize(img_gray, (self.max_width, int(img_gray.shape[0] * factor)),
+                                  interpolation=cv2.INTER_AREA)
+        faces = FaceDetect.face_cascade.detectMultiScale(img_gray, self.scale_factor, self.min_neighbors,
+                                                         minSize=(self.min_size, self.min_size))
+        return [tuple(int(v / factor) for v in face) for face in faces]
+
+    def detect(self, img):
+        faces = self.find(img)
         for (x, y, w, h) in faces:
             img = cv2.rectangle(img, (x, y), (x + w, y + h), (255, 255, 255), 2)
         return len(faces)
-
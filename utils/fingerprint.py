@@ -0,0 +1,67 @@
+import os
+import hashlib
+
+block_size = 64 * 1024
+block_count = 4
+
+
+def fingerprint(path):
+    """
+    Cheap content fingerprint of a file, the size plus a hash of a few blocks sampled over the file.
+    It survives renames and moves but reads at most block_count * block_size bytes.
+    :param path: file path
+    :return: str '<size>:<hash>', None if the file can not be read
+    """
+    try:
+        size = os.path.getsize(path)
+        md5 = hashlib.md5()
+        with open(path, mode='rb') as file:
+            if size <= block_size * block_count:
+                md5.update(file.read())
+            else:
+                step = (size - block_size) // (block_count - 1)
+                for i in range(block_count):
+                    file.seek(i * step)
+                    md5.update(file.read(block_size))
+    except OSError as e:
+        print('failed to fingerprint %s: %s' % (path, e))
+        return None
+    return '%d:%s' % (size, md5.hexdigest())
+
+
+partial_size = 4 * 1024 * 1024
+chunk_size = 1024 * 1024
+
+
+def partial_hash(path):
+    """
+    hash of the first and the last partial_size bytes, covers the whole file if it is small enough
+    """
+    size = os.path.getsize(path)
+    md5 = hashlib.md5()
+    with open(path, mode='rb') as file:
+        if size <= partial_size * 2:
+            _update_chunks(md5, file, size)
+        else:
+            _update_chunks(md5, file, partial_size)
+            file.seek(size - partial_size)
+            _update_chunks(md5, file, partial_size)
+    return md5.hexdigest()
+
+
+def full_hash(path):
+    md5 = hashlib.md5()
+    with open(path, mode='rb') as file:
+        _update_chunks(md5, file)
+    return md5.hexdigest()
+
+
+def _update_chunks(md5, file, length=None):
+    while length is None or length > 0:
+        size = chunk_size if length is None else min(chunk_size, length)
+        buff = file.read(size)
+        if not buff:
+            break
+        md5.update(buff)
+        if length is not None:
+            length -= len(buff)
@@ -0,0 +1,36 @@
+import sys
+import importlib
+import threading
+
+_lock = threading.Lock()
+
+
+class LazyModule:
+    """
+    Stands in for a module that is imported on first attribute access, so heavy modules such as cv2
+    and numpy are not loaded before the window shows. Safe to touch from several threads at once.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            with _lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return '<lazy module %s%s>' % (self._name, '' if self._module is None else ' (loaded)')
+
+
+def lazy_import(name):
+    """
+    :return: the module if it is imported already, otherwise a LazyModule for it
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
@@ -0,0 +1,61 @@
+from itertools import combinations
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing for hamming radius queries over fixed length hashes.
+    The hash is split into chunks and each chunk is indexed in its own table. Two hashes within
+    radius r share at least one chunk within r // chunks bits, so only the buckets reachable by
+    flipping that many bits of each chunk have to be looked at.
+    """
+
+    def __init__(self, bits=64, chunks=4):
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self.mask = (1 << self.chunk_bits) - 1
+        self.tables = [dict() for _ in range(chunks)]
+        self.items = []
+
+    def _split(self, h):
+        return [(h >> (i * self.chunk_bits)) & self.mask for i in range(self.chunks)]
+
+    def add(self, h, item):
+        index = len(self.items)
+        self.items.append((h, item))
+        for table, chunk in zip(self.tables, self._split(h)):
+            if chunk in table:
+                table[chunk].append(index)
+            else:
+                table[chunk] = [index]
+
+    def _probes(self, chunk, radius):
+        yield chunk
+        for r in range(1, radius + 1):
+            for positions in combinations(range(self.chunk_bits), r):
+                flipped = chunk
+                for position in positions:
+                    flipped ^= 1 << position
+                yield flipped
+
+    def find(self, h, radius):
+        """
+        :return: list of (distance, hash, item) sorted by distance
+        """
+        sub_radius = radius // self.chunks
+        seen = set()
+        results = []
+        for table, chunk in zip(self.tables, self._split(h)):
+            for probe in self._probes(chunk, sub_radius):
+                for index in table.get(probe, ()):
+                    if index in seen:
+                        continue
+                    seen.add(index)
+                    other, item = self.items[index]
+                    d = bin(h ^ other).count('1')
+                    if d <= radius:
+                        results.append((d, other, item))
+        results.sort(key=lambda result: result[0])
+        return results
+
+    def __len__(self):
+        return len(self.items)
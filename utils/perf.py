@@ -0,0 +1,123 @@
+import json
+import time
+import threading
+from functools import wraps
+
+# upper bounds of the histogram buckets in milliseconds, the last bucket takes everything slower
+bucket_bounds = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+enabled = False
+_histograms = dict()
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+
+    def record(self, ms):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        for i, bound in enumerate(bucket_bounds):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, q):
+        """
+        :return: upper bound in ms of the bucket holding the q quantile, the max for the last bucket
+        """
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return min(bucket_bounds[i], self.max) if i < len(bucket_bounds) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count > 0 else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': self.max,
+            'buckets': dict(zip([str(bound) for bound in bucket_bounds] + ['inf'], self.buckets))
+        }
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+def record(name, seconds):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].record(seconds * 1000)
+
+
+def timed(name):
+    """
+    Same as the _timeit decorator of PySimpleGUI except that the time goes into the histogram name
+    instead of being printed, and only while recording is enabled
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+class timer:
+    """
+    with timer(name): ... records the time of the block into the histogram name while recording is enabled
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            record(self.name, time.perf_counter() - self.start)
+
+
+def snapshot():
+    """
+    :return: dict name -> summary of the histogram, sorted by name
+    """
+    with _lock:
+        return {name: _histograms[name].to_dict() for name in sorted(_histograms)}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def export(file):
+    with open(file, mode='w') as f:
+        json.dump(snapshot(), f, indent=2)
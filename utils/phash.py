@@ -0,0 +1,46 @@
+from utils.lazy import lazy_import
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+hash_size = 8
+
+
+def dhash_frames(frames):
+    """
+    difference hashes of several frames, computed in one vectorised pass
+    :param frames: list of BGR or gray images
+    :return: list of 64 bit int
+    """
+    if len(frames) == 0:
+        return []
+    smalls = np.stack([cv2.resize(_gray(frame), (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+                       for frame in frames])
+    bits = smalls[:, :, 1:] > smalls[:, :, :-1]
+    packed = np.packbits(bits.reshape(len(frames), -1), axis=1)
+    return [int.from_bytes(row.tobytes(), 'big') for row in packed]
+
+
+def dhash(frame):
+    return dhash_frames([frame])[0]
+
+
+def combine(hashes):
+    """
+    per video signature, each bit is the majority of the same bit over the frame hashes
+    """
+    if len(hashes) == 0:
+        return None
+    data = np.array(hashes, dtype='>u8').view(np.uint8).reshape(len(hashes), 8)
+    bits = np.unpackbits(data, axis=1)
+    majority = bits.sum(axis=0) * 2 > len(hashes)
+    return int.from_bytes(np.packbits(majority).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _gray(frame):
+    if frame.ndim == 3:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
@@ -0,0 +1,79 @@
+from utils.lazy import lazy_import
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+blank_mean_low = 16
+blank_mean_high = 240
+blank_std = 8
+hist_bins = 4
+
+
+def luminance_stats(frames):
+    """
+    :return: (means, stds) of the luminance of each frame
+    """
+    grays = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]).reshape(len(frames), -1)
+    return grays.mean(axis=1), grays.std(axis=1)
+
+
+def blank_mask(frames):
+    """
+    :return: bool array, True for black, white or flat frames such as fades and title cards
+    """
+    means, stds = luminance_stats(frames)
+    return (means < blank_mean_low) | (means > blank_mean_high) | (stds < blank_std)
+
+
+def is_blank(frame):
+    return bool(blank_mask([frame])[0])
+
+
+def colour_histograms(frames):
+    """
+    normalised hist_bins ** 3 colour histogram of each frame as rows of a matrix
+    """
+    quantised = np.stack(frames).reshape(len(frames), -1, 3) // (256 // hist_bins)
+    codes = (quantised[:, :, 0].astype(np.int32) * hist_bins + quantised[:, :, 1]) * hist_bins + quantised[:, :, 2]
+    bins = hist_bins ** 3
+    offsets = np.arange(len(frames))[:, None] * bins
+    hists = np.bincount((codes + offsets).ravel(), minlength=len(frames) * bins).reshape(len(frames), bins)
+    return hists / hists.sum(axis=1, keepdims=True)
+
+
+def select_distinct(frames, count):
+    """
+    pick the count most distinct, non blank frames, starting with the strongest scene change and
+    then repeatedly the frame farthest from everything picked so far
+    :param frames: list of same sized BGR images in stream order
+    :return: sorted list of indexes into frames
+    """
+    if len(frames) <= count:
+        return list(range(len(frames)))
+    hists = colour_histograms(frames)
+    candidates = np.nonzero(~blank_mask(frames))[0]
+    if len(candidates) < count:
+        # not enough content, fill up with the least blank frames
+        _, stds = luminance_stats(frames)
+        candidates = np.sort(np.argsort(-stds)[:count])
+    changes = np.zeros(len(frames))
+    changes[1:] = np.abs(hists[1:] - hists[:-1]).sum(axis=1)
+    best = int(np.argmax(changes[candidates]))
+    picked = []
+    distances = np.full(len(candidates), np.inf)
+    while len(picked) < count:
+        picked.append(candidates[best])
+        distances = np.minimum(distances, np.abs(hists[candidates] - hists[candidates[best]]).sum(axis=1))
+        distances[best] = -1
+        best = int(np.argmax(distances))
+    return sorted(int(i) for i in picked)
+
+
+def activity(frames, size=(32, 32)):
+    """
+    motion/activity score in 0-100, the mean absolute luminance difference between consecutive frames
+    """
+    if len(frames) < 2:
+        return 0.0
+    grays = np.stack([cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), size, interpolation=cv2.INTER_AREA)
+                      for frame in frames]).astype(np.int16)
+    return float(np.abs(np.diff(grays, axis=0)).mean() * 100 / 255)
@@ -1,4 +1,6 @@
-import cv2
+from utils import perf
+from utils.lazy import lazy_import
+cv2 = lazy_import('cv2')
 
 
 class VideoScreenshot:
@@ -15,11 +17,45 @@ class VideoScreenshot:
             self.dur = 1
 
     def __del__(self):
-        self.cap.release()
+        self.release()
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
 
     def __str__(self):
         return "path:%s,dur:%fmin" % (self.path, self.dur / 60)
 
+    def stream(self, count, resize=None, seek_gap=60):
+        """
+        decode count frames evenly spread over the video, frames close to each other are reached by
+        grabbing forward, farther ones by seeking
+        :param count: decode budget, number of frames to return
+        :param resize: Tuple[int, int] (width, height) size of the image to resize
+        :param seek_gap: seek instead of grabbing when the next frame is more frames away than this
+        :return: generator of (percent, image)
+        """
+        if self.frames <= 0 or count <= 0:
+            return
+        step = max(self.frames / count, 1)
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        cur = 0
+        for i in range(count):
+            target = int(i * step)
+            if target >= self.frames:
+                break
+            if target - cur > seek_gap:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            else:
+                while cur < target and self.cap.grab():
+                    cur += 1
+            ret, img = self.cap.read()
+            cur = target + 1
+            if not ret:
+                break
+            yield target * 100 / self.frames, self._resize(img, resize)
+
     def grab(self, percent=None, resize=None):
         """
         :param percent:
@@ -30,6 +66,13 @@ class VideoScreenshot:
             self.cap.set(cv2.CAP_PROP_POS_FRAMES, int(self.frames * percent / 100))
         ret, img = self.cap.read()
         if ret and resize:
+            img = self._resize(img, resize)
+        return img
+
+    @staticmethod
+    @perf.timed('video/resize')
+    def _resize(img, resize):
+        if resize:
             height = img.shape[0]
             width = img.shape[1]
             factor1 = 1.0
@@ -1,9 +1,68 @@
 import os
-import cv2
+import json
+import time
 import base64
 import sqlite3
 import uuid
+import threading
 from utils.screen_shot import VideoScreenshot
+from utils.fingerprint import fingerprint
+from utils import phash
+from utils import scene_select
+from utils.colour import colour_signature
+from utils import perf
+from utils.lazy import lazy_import
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# columns added after the first release, in the order they were introduced
+_extra_columns = [
+    ('cache_size', 'int default 0'),
+    ('last_access', 'int default 0'),
+    ('fingerprint', 'varchar(64)'),
+    ('file_size', 'int'),
+    ('mtime', 'real'),
+    ('partial_hash', 'varchar(32)'),
+    ('full_hash', 'varchar(32)'),
+    ('signature', 'int'),
+    ('face_frames', 'int'),
+    ('motion', 'real'),
+    ('colour', 'blob'),
+    ('file_exists', 'int'),
+    ('exists_checked', 'real'),
+    ('duration', 'real'),
+    ('sort_path', 'varchar(1024)'),
+    ('hashes_generation', 'int'),
+]
+
+_extra_indexes = [
+    ('videos_last_access', 'last_access'),
+    ('videos_fingerprint', 'fingerprint'),
+    ('videos_file_size', 'file_size'),
+    ('videos_face_frames', 'face_frames'),
+    ('videos_motion', 'motion'),
+    ('videos_file_exists', 'file_exists'),
+    ('videos_score', 'score'),
+    ('videos_sort_path', 'sort_path'),
+    ('videos_duration_page', 'ifnull(duration, -1)'),
+    ('videos_size_page', 'ifnull(file_size, -1)'),
+    ('videos_hashes_generation', 'ifnull(hashes_generation, 0)'),
+]
+
+# sort orders of the paged history, rowid doubles as the date added and breaks ties
+sort_orders = {
+    'score': 'score',
+    'path': 'sort_path',
+    'added': 'rowid',
+    'duration': 'ifnull(duration, -1)',
+    'size': 'ifnull(file_size, -1)'
+}
+
+_size_from_fingerprint = "cast(substr(fingerprint, 1, instr(fingerprint, ':') - 1) as integer)"
+
+
+_upgraded_repos = set()
+_upgrade_lock = threading.Lock()
 
 
 def _create_repo(repo_file):
@@ -22,6 +81,84 @@ def _create_repo(repo_file):
     conn.close()
 
 
+def _upgrade_repo(conn):
+    cursor = conn.cursor()
+    cursor.execute('pragma table_info(videos)')
+    columns = [row[1] for row in cursor.fetchall()]
+    for name, definition in _extra_columns:
+        if name not in columns:
+            cursor.execute('alter table videos add column %s %s' % (name, definition))
+    cursor.execute(
+        """create table if not exists settings(
+            key varchar(64) primary key,
+            value text
+            )
+        """
+    )
+    cursor.execute(
+        """create table if not exists frame_hashes(
+            uuid varchar(64) not null,
+            idx int not null,
+            pos real,
+            hash int not null,
+            primary key (uuid, idx)
+            )
+        """
+    )
+    cursor.execute(
+        """create table if not exists faces(
+            uuid varchar(64) not null,
+            idx int not null,
+            count int not null,
+            boxes text,
+            primary key (uuid, idx)
+            )
+        """
+    )
+    cursor.execute(
+        """create table if not exists jobs(
+            id integer primary key autoincrement,
+            path varchar(1024) unique not null,
+            state varchar(16) not null default 'pending',
+            owner varchar(128),
+            lease_expires real,
+            heartbeat real,
+            attempts int default 0,
+            error text,
+            created real
+            )
+        """
+    )
+    cursor.execute('create index if not exists jobs_state on jobs(state)')
+    cursor.execute(
+        """create table if not exists roots(
+            name varchar(64) primary key,
+            path varchar(1024) unique not null,
+            suffixes text,
+            excludes text,
+            schedule real,
+            workers int,
+            read_ahead int,
+            offline int default 0,
+            last_scan real
+            )
+        """
+    )
+    cursor.execute('pragma table_info(roots)')
+    if 'mount_point' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('alter table roots add column mount_point varchar(1024)')
+    for name, column in _extra_indexes:
+        cursor.execute('create index if not exists %s on videos(%s)' % (name, column))
+    # fill the sort keys of records created before they were stored
+    cursor.execute('select rowid, path from videos where sort_path is null')
+    cursor.executemany('update videos set sort_path=? where rowid=?',
+                       [(_sort_path(_decode_path(path)), rowid) for rowid, path in cursor.fetchall()])
+    cursor.execute('update videos set file_size=%s where file_size is null and fingerprint is not null'
+                   % _size_from_fingerprint)
+    cursor.close()
+    conn.commit()
+
+
 def _decode_path(path):
     return base64.b64decode(path.encode()).decode('utf-8')
 
@@ -30,71 +167,493 @@ def _encode_path(path):
     return base64.b64encode(path.encode('utf-8')).decode()
 
 
+def _size_of(fp):
+    # fingerprints start with the file size
+    return int(fp.split(':')[0]) if fp is not None else None
+
+
+def _sort_path(path):
+    # paths are stored base64 encoded, which does not keep their order
+    return path.lower()
+
+
+def _to_signed(value):
+    # sqlite integers are signed 64 bit
+    if value is not None and value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def _to_unsigned(value):
+    if value is not None and value < 0:
+        value += 1 << 64
+    return value
+
+
+_columns = 'uuid, path, score, fingerprint, signature, motion, colour is not null'
+
+
 def _tuple_to_dict(value):
     if value is None or len(value) == 0:
         return None
     return {
         'uuid': value[0],
         'path': _decode_path(value[1]),
-        'score': value[2]
+        'score': value[2],
+        'fingerprint': value[3],
+        'signature': _to_unsigned(value[4]),
+        'motion': value[5],
+        'has_colour': bool(value[6])
     }
 
 
 class Repository:
     def __init__(self, repo_file):
-        if not os.path.exists(repo_file):
-            _create_repo(repo_file)
+        # upgraded once per file, the same relative name may be another file after a chdir
+        repo_file = os.path.abspath(repo_file)
+        if repo_file not in _upgraded_repos:
+            with _upgrade_lock:
+                if not os.path.exists(repo_file):
+                    _create_repo(repo_file)
+                if repo_file not in _upgraded_repos:
+                    conn = sqlite3.connect(repo_file)
+                    _upgrade_repo(conn)
+                    conn.close()
+                    _upgraded_repos.add(repo_file)
         self.conn = sqlite3.connect(repo_file)
 
+    @perf.timed('db/find_by_uuid')
     def find_by_uuid(self, uid):
         cursor = self.conn.cursor()
-        cursor.execute('select * from videos where uuid=?', (uid,))
+        cursor.execute('select ' + _columns + ' from videos where uuid=?', (uid,))
         value = cursor.fetchone()
         cursor.close()
         return _tuple_to_dict(value)
 
+    @perf.timed('db/find_by_path')
     def find_by_path(self, path):
         cursor = self.conn.cursor()
         path = _encode_path(path)
-        cursor.execute('select * from videos where path=?', (path,))
+        cursor.execute('select ' + _columns + ' from videos where path=?', (path,))
         value = cursor.fetchone()
         cursor.close()
         return _tuple_to_dict(value)
 
+    @perf.timed('db/find_all')
     def find_all(self):
         cursor = self.conn.cursor()
-        cursor.execute('select * from videos')
+        cursor.execute('select ' + _columns + ' from videos')
         values = cursor.fetchall()
         return [_tuple_to_dict(value) for value in values]
 
+    def find_page(self, order='added', descending=False, after=None, limit=500, lower=None, upper=None):
+        """
+        one page of the videos sorted by the repository, the next page starts after the key of the last row
+        :param order: one of sort_orders
+        :param after: key of the last row of the previous page, None for the first page
+        :param lower: only scores from lower to upper if given
+        :return: list of (key, path)
+        """
+        key = sort_orders[order]
+        direction = 'desc' if descending else 'asc'
+        conditions = []
+        args = []
+        if lower is not None:
+            conditions.append('score >= ? and score <= ?')
+            args += [lower, upper]
+        if after is not None:
+            # spelled out instead of a row value comparison, which sqlite does not search expression indexes with
+            op = '<' if descending else '>'
+            conditions.append('%s %s= ? and (%s %s ? or rowid %s ?)' % (key, op, key, op, op))
+            args += [after[0], after[0], after[1]]
+        where = 'where ' + ' and '.join(conditions) if len(conditions) > 0 else ''
+        cursor = self.conn.cursor()
+        cursor.execute('select %s, rowid, path from videos %s order by %s %s, rowid %s limit ?' %
+                       (key, where, key, direction, direction), args + [limit])
+        values = cursor.fetchall()
+        cursor.close()
+        return [((value[0], value[1]), _decode_path(value[2])) for value in values]
+
+    def count(self, lower=None, upper=None):
+        cursor = self.conn.cursor()
+        if lower is None:
+            cursor.execute('select count(*) from videos')
+        else:
+            cursor.execute('select count(*) from videos where score >= ? and score <= ?', (lower, upper))
+        value = cursor.fetchone()
+        cursor.close()
+        return value[0]
+
     def find_with_score(self, lower=1, upper=100):
         cursor = self.conn.cursor()
-        cursor.execute('select * from videos where score >= ? and score <= ? order by score desc', (lower, upper))
+        cursor.execute('select ' + _columns + ' from videos where score >= ? and score <= ? order by score desc',
+                       (lower, upper))
         values = cursor.fetchall()
         return [_tuple_to_dict(value) for value in values]
 
-    def insert(self, uid, path):
+    def find_by_fingerprint(self, fp):
         cursor = self.conn.cursor()
-        path = _encode_path(path)
-        cursor.execute('insert into videos(uuid, path) values (?, ?)', (uid, path))
+        cursor.execute('select ' + _columns + ' from videos where fingerprint=?', (fp,))
+        values = cursor.fetchall()
+        cursor.close()
+        return [_tuple_to_dict(value) for value in values]
+
+    def insert(self, uid, path, fp=None):
+        cursor = self.conn.cursor()
+        cursor.execute('insert into videos(uuid, path, fingerprint, file_size, sort_path) values (?, ?, ?, ?, ?)',
+                       (uid, _encode_path(path), fp, _size_of(fp), _sort_path(path)))
+        cursor.close()
+        self.conn.commit()
+
+    def update_fingerprint(self, uid, fp):
+        cursor = self.conn.cursor()
+        cursor.execute('update videos set fingerprint=?, file_size=? where uuid=?', (fp, _size_of(fp), uid))
         cursor.close()
         self.conn.commit()
 
+    def find_hashes(self, paths):
+        """
+        :return: dict of path -> (file_size, mtime, partial_hash, full_hash) for the recorded paths
+        """
+        cursor = self.conn.cursor()
+        hashes = {}
+        for path in paths:
+            cursor.execute('select file_size, mtime, partial_hash, full_hash from videos where path=?',
+                           (_encode_path(path),))
+            value = cursor.fetchone()
+            if value is not None:
+                hashes[path] = value
+        cursor.close()
+        return hashes
+
+    def find_existence(self, paths):
+        """
+        :return: dict of path -> (file exists, time of the check) for the checked paths
+        """
+        cursor = self.conn.cursor()
+        existence = {}
+        for path in paths:
+            cursor.execute('select file_exists, exists_checked from videos where path=? and exists_checked is not null',
+                           (_encode_path(path),))
+            value = cursor.fetchone()
+            if value is not None:
+                existence[path] = (bool(value[0]), value[1])
+        cursor.close()
+        return existence
+
+    def update_existence(self, values):
+        """
+        :param values: list of (path, file exists, time of the check)
+        """
+        cursor = self.conn.cursor()
+        cursor.executemany('update videos set file_exists=?, exists_checked=? where path=?',
+                           [(int(exists), checked, _encode_path(path)) for path, exists, checked in values])
+        cursor.close()
+        self.conn.commit()
+
+    def find_missing(self):
+        """
+        :return: paths found missing by the last check
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select path from videos where file_exists=0')
+        values = cursor.fetchall()
+        cursor.close()
+        return [_decode_path(value[0]) for value in values]
+
+    def update_hashes(self, values):
+        """
+        :param values: list of (path, file_size, mtime, partial_hash, full_hash)
+        """
+        cursor = self.conn.cursor()
+        cursor.executemany('update videos set file_size=?, mtime=?, partial_hash=?, full_hash=? where path=?',
+                           [(size, mtime, partial, full, _encode_path(path))
+                            for path, size, mtime, partial, full in values])
+        cursor.close()
+        self.conn.commit()
+
+    def update_signature(self, uid, signature, frame_hashes):
+        """
+        :param frame_hashes: list of (idx, pos, hash)
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('delete from frame_hashes where uuid=?', (uid,))
+        cursor.executemany('insert into frame_hashes(uuid, idx, pos, hash) values (?, ?, ?, ?)',
+                           [(uid, idx, pos, _to_signed(h)) for idx, pos, h in frame_hashes])
+        generation = self._next_generation(cursor, 'frame_hashes_generation')
+        cursor.execute('update videos set signature=?, hashes_generation=? where uuid=?',
+                       (_to_signed(signature), generation, uid))
+        cursor.close()
+        self.conn.commit()
+
+    def find_signatures(self):
+        """
+        :return: list of (uuid, path, signature) of the videos with a signature
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select uuid, path, signature from videos where signature is not null')
+        values = cursor.fetchall()
+        cursor.close()
+        return [(uid, _decode_path(path), _to_unsigned(signature)) for uid, path, signature in values]
+
+    def find_frame_hashes(self, uid):
+        """
+        :return: list of (idx, pos, hash) ordered by idx
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select idx, pos, hash from frame_hashes where uuid=? order by idx', (uid,))
+        values = cursor.fetchall()
+        cursor.close()
+        return [(idx, pos, _to_unsigned(h)) for idx, pos, h in values]
+
+    def find_frame_hashes_since(self, generation=-1):
+        """
+        :return: list of (uuid, pos, hash) of the videos whose frame hashes were written after generation,
+                 all of them for -1
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select h.uuid, h.pos, h.hash from videos v join frame_hashes h on h.uuid=v.uuid '
+                       'where ifnull(v.hashes_generation, 0) > ? order by h.uuid, h.idx', (generation,))
+        values = cursor.fetchall()
+        cursor.close()
+        return [(uid, pos, _to_unsigned(h)) for uid, pos, h in values]
+
+    def update_faces(self, uid, faces):
+        """
+        :param faces: list of (idx, boxes), boxes is a list of (x, y, w, h) in small frame coordinates
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('delete from faces where uuid=?', (uid,))
+        cursor.executemany('insert into faces(uuid, idx, count, boxes) values (?, ?, ?, ?)',
+                           [(uid, idx, len(boxes), json.dumps(boxes)) for idx, boxes in faces])
+        cursor.execute('update videos set face_frames=? where uuid=?',
+                       (sum(1 for _, boxes in faces if len(boxes) > 0), uid))
+        cursor.close()
+        self.conn.commit()
+
+    def clear_faces(self, uid):
+        """
+        forget the faces of frames that were replaced, the video is pending for face indexing again
+        """
+        self.conn.execute('delete from faces where uuid=?', (uid,))
+        self.conn.execute('update videos set face_frames=null where uuid=?', (uid,))
+        self.conn.commit()
+
+    def find_faces_pending(self):
+        cursor = self.conn.cursor()
+        cursor.execute('select uuid from videos where face_frames is null and score >= 0')
+        values = cursor.fetchall()
+        cursor.close()
+        return [value[0] for value in values]
+
+    def find_with_faces(self, min_frames=1):
+        cursor = self.conn.cursor()
+        cursor.execute('select ' + _columns + ' from videos where face_frames >= ? order by face_frames desc',
+                       (min_frames,))
+        values = cursor.fetchall()
+        cursor.close()
+        return [_tuple_to_dict(value) for value in values]
+
+    def update_motion(self, uid, motion):
+        cursor = self.conn.cursor()
+        cursor.execute('update videos set motion=? where uuid=?', (motion, uid))
+        cursor.close()
+        self.conn.commit()
+
+    def update_colour(self, uid, colour):
+        cursor = self.conn.cursor()
+        cursor.execute('update videos set colour=? where uuid=?', (colour, uid))
+        self._next_generation(cursor, 'colour_generation')
+        cursor.close()
+        self.conn.commit()
+
+    def find_colours(self):
+        """
+        :return: list of (uuid, colour) of the videos with a colour signature
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select uuid, colour from videos where colour is not null')
+        values = cursor.fetchall()
+        cursor.close()
+        return values
+
+    def stats(self):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """select count(*), sum(cache_size > 0), sum(max(cache_size, 0)), sum(score > 0),
+                      sum(signature is not null), sum(face_frames is not null), sum(face_frames > 0)
+               from videos
+            """
+        )
+        value = cursor.fetchone()
+        cursor.close()
+        keys = ['videos', 'cached', 'cache_bytes', 'marked', 'hashed', 'face_indexed', 'with_faces']
+        return {key: v or 0 for key, v in zip(keys, value)}
+
+    def find_with_motion(self, lower=0, upper=100):
+        cursor = self.conn.cursor()
+        cursor.execute('select ' + _columns + ' from videos where motion >= ? and motion <= ? order by motion desc',
+                       (lower, upper))
+        values = cursor.fetchall()
+        cursor.close()
+        return [_tuple_to_dict(value) for value in values]
+
     def update_score(self, uid, score):
         cursor = self.conn.cursor()
         cursor.execute('update videos set score=? where uuid=?', (score, uid))
         cursor.close()
         self.conn.commit()
 
+    def update_duration(self, uid, duration):
+        cursor = self.conn.cursor()
+        cursor.execute('update videos set duration=? where uuid=?', (duration, uid))
+        cursor.close()
+        self.conn.commit()
+
     def update_path(self, uid, path):
         cursor = self.conn.cursor()
-        path = _encode_path(path)
-        cursor.execute('update videos set path=? where uuid=?', (path, uid))
+        # the last existence check was about the old path
+        cursor.execute('update videos set path=?, sort_path=?, file_exists=null, exists_checked=null where uuid=?',
+                       (_encode_path(path), _sort_path(path), uid))
         cursor.close()
         self.conn.commit()
 
+    def update_cache_info(self, uid, cache_size, last_access=None):
+        if last_access is None:
+            last_access = int(time.time())
+        cursor = self.conn.cursor()
+        cursor.execute('update videos set cache_size=?, last_access=? where uuid=?', (cache_size, last_access, uid))
+        cursor.close()
+        self.conn.commit()
+
+    def touch(self, uid):
+        cursor = self.conn.cursor()
+        cursor.execute('update videos set last_access=? where uuid=?', (int(time.time()), uid))
+        cursor.close()
+        self.conn.commit()
+
+    def find_cache_entries(self):
+        """
+        :return: list of (uuid, score, cache_size, last_access) tuples, least recently used first
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select uuid, score, cache_size, last_access from videos order by last_access')
+        values = cursor.fetchall()
+        cursor.close()
+        return values
+
+    def find_paths(self, uids):
+        cursor = self.conn.cursor()
+        paths = []
+        for uid in uids:
+            cursor.execute('select path from videos where uuid=?', (uid,))
+            value = cursor.fetchone()
+            if value is not None:
+                paths.append(_decode_path(value[0]))
+        cursor.close()
+        return paths
+
+    def find_under(self, folder):
+        """
+        :return: list of (uuid, path) of the videos anywhere below folder
+        """
+        prefix = os.path.join(folder, '')
+        low = _sort_path(prefix)
+        # every sort path starting with low sorts before low with its separator bumped by one
+        high = low[:-1] + chr(ord(low[-1]) + 1)
+        cursor = self.conn.cursor()
+        cursor.execute('select uuid, path from videos where sort_path >= ? and sort_path < ?', (low, high))
+        values = cursor.fetchall()
+        cursor.close()
+        values = [(uid, _decode_path(path)) for uid, path in values]
+        return [(uid, path) for uid, path in values if path.startswith(prefix)]
+
     def delete(self, uid):
+        self.conn.execute('delete from jobs where path=(select path from videos where uuid=?)', (uid,))
         self.conn.execute('delete from videos where uuid=?', (uid,))
+        self.conn.execute('delete from frame_hashes where uuid=?', (uid,))
+        self.conn.execute('delete from faces where uuid=?', (uid,))
+        cursor = self.conn.cursor()
+        self._next_generation(cursor, 'frame_hashes_generation')
+        self._next_generation(cursor, 'colour_generation')
+        cursor.close()
+        self.conn.commit()
+
+    def get_setting(self, key, default=None):
+        cursor = self.conn.cursor()
+        cursor.execute('select value from settings where key=?', (key,))
+        value = cursor.fetchone()
+        cursor.close()
+        if value is None:
+            return default
+        return json.loads(value[0])
+
+    def set_setting(self, key, value):
+        self.conn.execute('insert or replace into settings(key, value) values (?, ?)', (key, json.dumps(value)))
+        self.conn.commit()
+
+    @staticmethod
+    def _next_generation(cursor, key):
+        """
+        count a change of the data an in memory index is built from, in the transaction of the change
+        :return: the new generation
+        """
+        cursor.execute("insert or ignore into settings(key, value) values (?, '0')", (key,))
+        cursor.execute('update settings set value=cast(value as integer) + 1 where key=?', (key,))
+        cursor.execute('select value from settings where key=?', (key,))
+        return int(cursor.fetchone()[0])
+
+    def get_generation(self, key):
+        """
+        :param key: frame_hashes_generation or colour_generation
+        :return: number of changes counted so far, compare it to tell whether an index is stale
+        """
+        return self.get_setting(key, 0)
+
+    def find_roots(self):
+        """
+        :return: list of library root dicts, see library.default_root for the keys
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('select name, path, suffixes, excludes, schedule, workers, read_ahead, offline, last_scan, '
+                       'mount_point from roots order by name')
+        values = cursor.fetchall()
+        cursor.close()
+        return [{
+            'name': value[0],
+            'path': _decode_path(value[1]),
+            'suffixes': json.loads(value[2]) if value[2] is not None else None,
+            'excludes': json.loads(value[3]) if value[3] is not None else [],
+            'schedule': value[4],
+            'workers': value[5],
+            'read_ahead': bool(value[6]) if value[6] is not None else None,
+            'offline': bool(value[7]),
+            'last_scan': value[8],
+            'mount_point': _decode_path(value[9]) if value[9] is not None else None
+        } for value in values]
+
+    def save_root(self, root):
+        self.conn.execute('insert or replace into roots(name, path, suffixes, excludes, schedule, workers, read_ahead, '
+                          'offline, last_scan, mount_point) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (root['name'], _encode_path(root['path']),
+                           json.dumps(root['suffixes']) if root['suffixes'] is not None else None,
+                           json.dumps(root['excludes']), root['schedule'], root['workers'],
+                           int(root['read_ahead']) if root['read_ahead'] is not None else None,
+                           int(root['offline']), root['last_scan'],
+                           _encode_path(root['mount_point']) if root['mount_point'] is not None else None))
+        self.conn.commit()
+
+    def update_root_state(self, name, offline=None, last_scan=None, mount_point=None):
+        if offline is not None:
+            self.conn.execute('update roots set offline=? where name=?', (int(offline), name))
+        if mount_point is not None:
+            self.conn.execute('update roots set mount_point=? where name=?', (_encode_path(mount_point), name))
+        if last_scan is not None:
+            self.conn.execute('update roots set last_scan=? where name=?', (last_scan, name))
+        self.conn.commit()
+
+    def delete_root(self, name):
+        self.conn.execute('delete from roots where name=?', (name,))
         self.conn.commit()
 
     def __del__(self):
@@ -104,8 +663,89 @@ class Repository:
 cache_dir = 'cache'
 cache_repo = 'cache.db'
 
+# the small frames the features are computed from, cached as cache_dir/uuid
 small_frame_size = (240, 160)
+# every cached thumbnail size, all scaled from one decode of each frame at the largest size. Sizes other
+# than small_frame_size are cached as cache_dir/uuid@width, views pick the closest one and scale it down
+thumbnail_sizes = [(120, 80), small_frame_size, (480, 320)]
 frame_size = (960, 480)
+small_frame_count = 12
+
+# 'fixed' grabs frames at 8%, 16% ... 96%, 'scene' picks the most distinct frames of a streamed decode
+sample_modes = ['fixed', 'scene']
+default_sample_mode = 'fixed'
+default_sample_budget = 120
+# extra seeks per video allowed to replace blank or repeated frames in 'fixed' mode
+default_retry_budget = 12
+retry_offsets = [2, -2, 4, -4]
+repeat_distance = 4
+
+
+def cache_uid(name):
+    """
+    :return: uuid of the video a cache file name belongs to
+    """
+    return name.split('@')[0]
+
+
+def scale_down(frame, box):
+    """
+    :param box: (width, height) the frame is fitted into, keeping its aspect ratio
+    """
+    height, width = frame.shape[:2]
+    factor = min(1.0, box[0] / width, box[1] / height)
+    if factor >= 1.0:
+        return frame
+    return cv2.resize(frame, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_AREA)
+
+
+def thumbnail_pyramid(frame):
+    """
+    :param frame: decoded at the largest of thumbnail_sizes
+    :return: dict width -> the frame fitted into each of thumbnail_sizes, each scaled from the one above
+    """
+    levels = {}
+    for size in sorted(thumbnail_sizes, reverse=True):
+        frame = scale_down(frame, size)
+        levels[size[0]] = frame
+    return levels
+
+
+def write_cache(cache_file, header, frames):
+    with open(cache_file, mode='wb') as file:
+        header = json.dumps(header).encode('utf-8')
+        file.write(0xacbd.to_bytes(length=2, byteorder='little'))
+        file.write(len(header).to_bytes(length=4, byteorder='little'))
+        file.write(header)
+        for frame in frames:
+            file.write(0xacbc.to_bytes(length=2, byteorder='little'))
+            file.write(len(frame).to_bytes(length=4, byteorder='little'))
+            file.write(frame)
+        file.write(0xffff.to_bytes(length=2, byteorder='little'))
+
+
+def read_cache(cache_file):
+    """
+    :return: (header, list of the encoded small frames) of the cache file, (None, None) if the file is broken
+    """
+    header = {}
+    frames = []
+    with open(cache_file, mode='rb') as file:
+        while True:
+            buff = file.read(2)
+            magic = int.from_bytes(buff, 'little')
+            if magic == 0xffff:
+                # print('reach cache file end')
+                return header, frames
+            if magic != 0xacbc and magic != 0xacbd:
+                print('error cache file')
+                return None, None
+            buff = file.read(4)
+            length = int.from_bytes(buff, 'little')
+            if magic == 0xacbd:
+                header = json.loads(file.read(length).decode('utf-8'))
+            else:
+                frames.append(file.read(length))
 
 
 class VideoFile:
@@ -113,26 +753,100 @@ class VideoFile:
         self.path = path
         self.uid = None
         self.score = 0
+        self.fingerprint = None
+        # the fingerprint was taken from the file by this instance, not loaded from the record
+        self._fingerprinted = False
+        self.signature = None
+        self.motion = None
+        self.has_colour = False
         repo = Repository(cache_repo)
         if path is not None:
             rcd = repo.find_by_path(path)
+            if rcd is None:
+                rcd = self._find_moved(repo)
             if rcd is None:
                 self.uid = str(uuid.uuid4())
-                repo.insert(self.uid, path)
+                repo.insert(self.uid, path, self.fingerprint)
             else:
                 self.uid = rcd['uuid']
                 self.score = rcd['score']
+                self.fingerprint = rcd['fingerprint']
+                self.signature = rcd['signature']
+                self.motion = rcd['motion']
+                self.has_colour = rcd['has_colour']
         else:
             raise Exception('invalid arguments')
         self.screenshot = None
         self.small_frames = []
+        self.small_cv_frames = []
+        # width -> decoded and encoded frames of the other thumbnail sizes while indexing
+        self.level_cv_frames = {}
+        self.level_frames = {}
+        # width -> encoded frames scaled for a view
+        self.thumbnails = {}
+        self.positions = []
+        self.sample_mode = default_sample_mode
         self.cur_cv_frame = None
         self.cur_frame = None
+        self.cur_pos = None
+        self.duration = None
+
+    def _find_moved(self, repo):
+        """
+        look for a record of the same content whose file is gone, the video was moved or renamed. A file
+        whose folder is gone too, or which lies below an offline library root, is on a drive that is not
+        mounted, this is a copy of it
+        """
+        if not os.path.isfile(self.path):
+            return None
+        self.fingerprint = fingerprint(self.path)
+        if self.fingerprint is None:
+            return None
+        self._fingerprinted = True
+        records = repo.find_by_fingerprint(self.fingerprint)
+        offline = [root['path'] for root in repo.find_roots() if root['offline']] if len(records) > 0 else []
+        for rcd in records:
+            if any(rcd['path'].startswith(os.path.join(root, '')) for root in offline):
+                continue
+            if os.path.isdir(os.path.dirname(rcd['path'])) and not os.path.exists(rcd['path']):
+                print('detect moved file from %s to %s' % (rcd['path'], self.path))
+                repo.update_path(rcd['uuid'], self.path)
+                return rcd
+        return None
+
+    def update_fingerprint(self):
+        """
+        fingerprint records created before fingerprints were stored
+        """
+        if self.fingerprint is None and self.is_file_exist():
+            self.fingerprint = fingerprint(self.path)
+            if self.fingerprint is not None:
+                Repository(cache_repo).update_fingerprint(self.uid, self.fingerprint)
+                self._fingerprinted = True
+        return self.fingerprint
+
+    def is_modified(self):
+        """
+        fingerprint the file again and record the new one, e.g. when its content was replaced in place
+        :return: True if the content differs from the one the record, and so the cache, was made of
+        """
+        recorded = self.fingerprint
+        if recorded is None or self._fingerprinted or not self.is_file_exist():
+            return False
+        current = fingerprint(self.path)
+        self._fingerprinted = True
+        if current is None or current == recorded:
+            return False
+        print('detect modified file ' + self.path)
+        self.fingerprint = current
+        Repository(cache_repo).update_fingerprint(self.uid, current)
+        return True
 
     def _init_screen_shot(self):
         if self.screenshot is None:
             self.screenshot = VideoScreenshot(self.path)
 
+    @perf.timed('video/grab_frame')
     def grab_frame(self, pos=None):
         self._init_screen_shot()
         size = frame_size
@@ -143,6 +857,7 @@ class VideoFile:
         if frame is not None:
             self.cur_cv_frame = frame
             self.cur_frame = cv2.imencode('.png', frame)[1].tobytes()
+            self.cur_pos = pos if pos and pos > 0 else None
         return self.cur_frame
 
     def get_cur_frame(self):
@@ -151,63 +866,285 @@ class VideoFile:
     def get_cur_cv_frame(self):
         return self.cur_cv_frame
 
-    def grab_small_frames(self):
+    def grab_small_frames(self, mode=None, budget=None):
+        """
+        :param mode: one of sample_modes, the sample_mode setting if None
+        :param budget: number of frames decoded in 'scene' mode, the sample_budget setting if None
+        """
+        self.decode_small_frames(mode, budget)
+        return self.encode_small_frames()
+
+    @perf.timed('video/decode_small_frames')
+    def decode_small_frames(self, mode=None, budget=None):
         self._init_screen_shot()
+        self._clear_frames()
+        self.positions.clear()
+        if mode is None or budget is None:
+            repo = Repository(cache_repo)
+            mode = mode or repo.get_setting('sample_mode', default_sample_mode)
+            budget = budget or repo.get_setting('sample_budget', default_sample_budget)
+        self.sample_mode = mode
+        if self.screenshot.fps > 0:
+            self.duration = self.screenshot.frames / self.screenshot.fps
+        if mode == 'scene':
+            self._grab_scene_frames(budget)
+        else:
+            self._grab_fixed_frames()
+        return self.small_cv_frames
+
+    @perf.timed('video/encode_small_frames')
+    def encode_small_frames(self):
         self.small_frames.clear()
-        size = small_frame_size
-        for i in range(1, 13):
-            frame = self.screenshot.grab(8 * i, size)
-            if frame is None:
-                break
+        for frame in self.small_cv_frames:
             img_bytes = cv2.imencode('.png', frame)[1].tobytes()
             self.small_frames.append(img_bytes)
+        self.level_frames = {width: [cv2.imencode('.png', frame)[1].tobytes() for frame in frames]
+                             for width, frames in self.level_cv_frames.items()}
         return self.small_frames
 
+    def frames_nbytes(self):
+        nbytes = sum(frame.nbytes for frame in self.small_cv_frames) + sum(len(frame) for frame in self.small_frames)
+        for frames in self.level_cv_frames.values():
+            nbytes += sum(frame.nbytes for frame in frames)
+        for frames in self.level_frames.values():
+            nbytes += sum(len(frame) for frame in frames)
+        return nbytes
+
+    def _clear_frames(self):
+        self.small_frames.clear()
+        self.small_cv_frames.clear()
+        self.level_cv_frames = {}
+        self.level_frames = {}
+        self.thumbnails = {}
+
+    def _add_frame(self, levels):
+        """
+        :param levels: dict width -> frame, from thumbnail_pyramid
+        """
+        for width, frame in levels.items():
+            if width == small_frame_size[0]:
+                self.small_cv_frames.append(frame)
+            else:
+                self.level_cv_frames.setdefault(width, []).append(frame)
+
+    def close(self):
+        """
+        release the decoder and the frames, the video can still be used and reopens them on demand
+        """
+        if self.screenshot is not None:
+            self.screenshot.release()
+            self.screenshot = None
+        self._clear_frames()
+
+    def _grab_levels(self, pos):
+        frame = self.screenshot.grab(pos, max(thumbnail_sizes))
+        return thumbnail_pyramid(frame) if frame is not None else None
+
+    def _grab_fixed_frames(self, retry_budget=default_retry_budget):
+        width = small_frame_size[0]
+        hashes = []
+        for i in range(1, small_frame_count + 1):
+            pos = 8 * i
+            levels = self._grab_levels(pos)
+            if levels is None:
+                break
+            h = phash.dhash(levels[width])
+            if self._is_rejected(levels[width], h, hashes):
+                for offset in retry_offsets:
+                    if retry_budget <= 0:
+                        break
+                    retry_budget -= 1
+                    alternative = self._grab_levels(pos + offset)
+                    if alternative is None:
+                        continue
+                    alternative_hash = phash.dhash(alternative[width])
+                    if not self._is_rejected(alternative[width], alternative_hash, hashes):
+                        levels, h, pos = alternative, alternative_hash, pos + offset
+                        break
+            self._add_frame(levels)
+            self.positions.append(pos)
+            hashes.append(h)
+
+    @staticmethod
+    def _is_rejected(frame, h, hashes):
+        """
+        black, white or flat frames and frames repeating an accepted one are replaced if possible
+        """
+        if scene_select.is_blank(frame):
+            return True
+        return any(phash.hamming(h, other) <= repeat_distance for other in hashes)
+
+    def _grab_scene_frames(self, budget):
+        width = small_frame_size[0]
+        candidates = []
+        for pos, frame in self.screenshot.stream(max(budget, small_frame_count), max(thumbnail_sizes)):
+            # the large size of every candidate is held as jpeg until the picks are known, a budget of decoded
+            # large frames would not fit the memory bound of the pipeline
+            top = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 95])[1]
+            candidates.append((pos, thumbnail_pyramid(frame)[width], top))
+        if len(candidates) == 0:
+            return
+        for i in scene_select.select_distinct([small for _, small, _ in candidates], small_frame_count):
+            pos, small, top = candidates[i]
+            levels = thumbnail_pyramid(cv2.imdecode(top, cv2.IMREAD_COLOR))
+            # the small frame and the sizes below it come from the frame the selection saw
+            levels.update({level: frame for level, frame in thumbnail_pyramid(small).items() if level <= width})
+            self._add_frame(levels)
+            self.positions.append(round(pos, 2))
+
     def get_small_frames(self):
         return self.small_frames
 
+    def get_small_cv_frames(self):
+        """
+        decoded small frames, taken from the last grab or decoded from the cached pngs
+        """
+        if len(self.small_cv_frames) == 0:
+            for frame in self.small_frames:
+                self.small_cv_frames.append(cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR))
+        return self.small_cv_frames
+
+    def frame_positions(self):
+        """
+        position in percent of each small frame
+        """
+        if len(self.positions) == len(self.small_frames):
+            return self.positions
+        return [8 * (i + 1) for i in range(len(self.small_frames))]
+
+    def update_signature(self):
+        """
+        perceptual hashes of the small frames and their majority as the signature of the video
+        """
+        hashes = phash.dhash_frames(self.get_small_cv_frames())
+        if len(hashes) == 0:
+            return None
+        self.signature = phash.combine(hashes)
+        frame_hashes = [(i, pos, h) for i, (pos, h) in enumerate(zip(self.frame_positions(), hashes))]
+        Repository(cache_repo).update_signature(self.uid, self.signature, frame_hashes)
+        return self.signature
+
+    def update_motion(self):
+        """
+        activity between consecutive small frames, reuses the frames decoded for the thumbnails
+        """
+        frames = self.get_small_cv_frames()
+        if len(frames) == 0:
+            return None
+        self.motion = scene_select.activity(frames)
+        Repository(cache_repo).update_motion(self.uid, self.motion)
+        return self.motion
+
+    def update_colour(self):
+        signature = colour_signature(self.get_small_cv_frames())
+        if signature is None:
+            return None
+        self.has_colour = True
+        Repository(cache_repo).update_colour(self.uid, signature.tobytes())
+        return signature
+
+    def has_features(self):
+        return self.signature is not None and self.motion is not None and self.has_colour
+
+    def update_features(self):
+        """
+        everything derived from the small frames, computed once they are grabbed or loaded
+        """
+        self.update_signature()
+        self.update_motion()
+        self.update_colour()
+
     def is_cache_exist(self):
         return os.path.exists(self._cache_file())
 
     def is_file_exist(self):
         return os.path.exists(self.path)
 
-    def _cache_file(self):
-        return os.path.join(cache_dir, self.uid)
+    def _cache_file(self, width=None):
+        """
+        :param width: one of the widths of thumbnail_sizes, the small frames if None
+        """
+        if width is None or width == small_frame_size[0]:
+            return os.path.join(cache_dir, self.uid)
+        return os.path.join(cache_dir, '%s@%d' % (self.uid, width))
+
+    def _cache_files(self):
+        return [self._cache_file(size[0]) for size in thumbnail_sizes]
 
-    def load_cache(self):
-        cache_file = os.path.join(cache_dir, self.uid)
+    @perf.timed('cache/load')
+    def load_cache(self, touch=True):
+        cache_file = self._cache_file()
         if not os.path.exists(cache_file):
             return False
-        self.small_frames.clear()
-        with open(cache_file, mode='rb') as file:
-            while True:
-                buff = file.read(2)
-                magic = int.from_bytes(buff, 'little')
-                if magic == 0xffff:
-                    # print('reach cache file end')
-                    return True
-                if magic != 0xacbc:
-                    print('error cache file')
-                    return False
-                buff = file.read(4)
-                length = int.from_bytes(buff, 'little')
-                self.small_frames.append(file.read(length))
+        self._clear_frames()
+        header, frames = read_cache(cache_file)
+        if frames is None:
+            return False
+        self.small_frames += frames
+        self.sample_mode = header.get('mode', 'fixed')
+        self.positions = header.get('positions', [])
+        if touch:
+            Repository(cache_repo).touch(self.uid)
+        return True
+
+    @perf.timed('cache/thumbnails')
+    def get_thumbnails(self, width):
+        """
+        small frames for a view, from the closest cached size at least as wide, scaled down to width
+        :return: list of encoded frames, the small frames if no size is cached besides them
+        """
+        if width in self.thumbnails:
+            return self.thumbnails[width]
+        widths = sorted(size[0] for size in thumbnail_sizes if size[0] >= width)
+        widths += sorted((size[0] for size in thumbnail_sizes if size[0] < width), reverse=True)
+        frames = self.small_frames
+        frames_width = small_frame_size[0]
+        for level in widths:
+            if level == small_frame_size[0]:
+                break
+            if os.path.exists(self._cache_file(level)):
+                _, level_frames = read_cache(self._cache_file(level))
+                if level_frames is not None and len(level_frames) == len(self.small_frames):
+                    frames, frames_width = level_frames, level
+                    break
+        if frames_width <= width:
+            # a cached size, or the largest one below width, nothing to decode
+            self.thumbnails[width] = frames
+            return frames
+        box = (width, width * small_frame_size[1] / small_frame_size[0])
+        scaled = []
+        for frame in frames:
+            image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None or image.shape[1] <= width:
+                scaled.append(frame)
+            else:
+                scaled.append(cv2.imencode('.png', scale_down(image, box))[1].tobytes())
+        self.thumbnails[width] = scaled
+        return scaled
 
     def save_cache(self):
         if not os.path.isdir(cache_dir):
             os.mkdir(cache_dir)
-        with open(os.path.join(cache_dir, self.uid), mode='wb') as file:
-            for frame in self.small_frames:
-                file.write(0xacbc.to_bytes(length=2, byteorder='little'))
-                file.write(len(frame).to_bytes(length=4, byteorder='little'))
-                file.write(frame)
-            file.write(0xffff.to_bytes(length=2, byteorder='little'))
+        header = {
+            'mode': self.sample_mode,
+            'positions': self.frame_positions()
+        }
+        write_cache(self._cache_file(), header, self.small_frames)
+        for width, frames in self.level_frames.items():
+            write_cache(self._cache_file(width), header, frames)
+        size = sum(os.path.getsize(file) for file in self._cache_files() if os.path.exists(file))
+        repo = Repository(cache_repo)
+        repo.update_cache_info(self.uid, size)
+        # the faces were found in the frames just replaced
+        repo.clear_faces(self.uid)
+        if self.duration is not None:
+            repo.update_duration(self.uid, self.duration)
 
     def delete_cache(self):
         Repository(cache_repo).delete(self.uid)
-        if self.is_cache_exist():
-            os.remove(self._cache_file())
+        for file in self._cache_files():
+            if os.path.exists(file):
+                os.remove(file)
 
     def set_score(self, score):
         self.score = score
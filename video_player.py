@@ -1,68 +1,56 @@
-import threading
-import queue
+import time
+# start of the imports, the time to first paint is measured from here
+_started = time.perf_counter()
+import zlib
+from collections import OrderedDict
 import PySimpleGUI as sg
-from utils.face_detect import FaceDetect
+from utils.face_detect import FaceDetect, default_params
+from utils import perf
 from video_file import *
+from video_process import MediaFinder, VideoProcess
+import cache_manager
+from cache_manager import CacheManager
+from duplicate_finder import DuplicateFinder
+from similar_finder import SimilarFinder
+from frame_index import FrameIndex
+from face_indexer import FaceIndexer
+from colour_index import ColourIndex
+from task_runner import TaskRunner, task_done_event
+from existence_scanner import ExistenceScanner
+from library_watcher import LibraryWatcher
+from library import Library, LibraryScheduler
+from job_queue import JobQueue
 
+# created by video_processor once the window is up
+_video_processor = None
 
-class MediaFinder:
-    def __init__(self, folder, suffixes=None):
-        if suffixes is None:
-            suffixes = ['.mp4',
-                        '.avi',
-                        '.wmv',
-                        '.rmvb',
-                        '.mkv',
-                        '.TS',
-                        '.ts'
-                        ]
-        self.root = folder
-        self.suffixes = suffixes
-        self.files = []
-
-    def find_all(self):
-        for root, dirs, files in os.walk(self.root):
-
-            for file in files:
-                for suffix in self.suffixes:
-                    if file.endswith(suffix):
-                        path = os.path.join(root, file)
-                        path = path.replace('/', '\\')
-                        self.files.append(path)
-        return self.files
-
-
-class VideoProcess(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self, name='video_process')
-        self._que = queue.Queue()
-        self._is_stopped = False
+history_page_size = 500
 
-    def run(self):
-        while not self._is_stopped:
-            msg = self._que.get(True)
-            if msg is None:
-                print('process thread quit')
-                break
-            path = msg['path']
-            print('process ' + path)
-            video = VideoFile(path=path)
-            if (not video.is_cache_exist()) and (video.get_score() >= 0):
-                video.grab_small_frames()
-                video.save_cache()
+default_watch = {'enabled': False, 'folders': [], 'polling': False}
+
+
+def video_processor():
+    """
+    :return: the background indexer, started on first use
+    """
+    global _video_processor
+    if _video_processor is None:
+        _video_processor = VideoProcess()
+        _video_processor.start()
+    return _video_processor
+
+
+def _pack_paths(paths):
+    return base64.b64encode(zlib.compress('\n'.join(paths).encode('utf-8'))).decode()
 
-    def process(self, path):
-        self._que.put({
-            'path': path
-        })
 
-    def stop(self):
-        self._que.put(None)
-        self._is_stopped = True
-        self.join()
+def _unpack_paths(packed):
+    text = zlib.decompress(base64.b64decode(packed.encode())).decode('utf-8')
+    return text.split('\n') if len(text) > 0 else []
 
 
-_video_processor = VideoProcess()
+history_orders = OrderedDict([('score', 'Score'), ('path', 'Path'), ('added', 'Date added'),
+                              ('duration', 'Duration'), ('size', 'Size')])
 
 
 class ScoreMarkWindow:
@@ -126,11 +114,11 @@ class DirectoryChangeWindow:
 
 
 class SelectByScoreWindow:
-    def __init__(self):
-        layout = [[sg.Text('score range')],
-                  [sg.InputText(default_text='60', size=(10, 1), key='_lower_'),
+    def __init__(self, text='score range', lower=60, upper=100):
+        layout = [[sg.Text(text)],
+                  [sg.InputText(default_text=str(lower), size=(10, 1), key='_lower_'),
                    sg.Text('-'),
-                   sg.InputText(default_text='100', size=(10, 1), key='_upper_'),
+                   sg.InputText(default_text=str(upper), size=(10, 1), key='_upper_'),
                    sg.Button('Ok', size=(5, 1), bind_return_key=True)]
                   ]
         self.window = sg.Window(title='Select', layout=layout, keep_on_top=True)
@@ -153,6 +141,191 @@ class SelectByScoreWindow:
         del self.window
 
 
+class CacheQuotaWindow:
+    def __init__(self, quota_mb, spare_score):
+        layout = [[sg.Text('Cache quota (MB)'),
+                   sg.InputText(default_text=str(quota_mb), size=(10, 1), key='_quota_')],
+                  [sg.Text('Never evict scores >='),
+                   sg.InputText(default_text=str(spare_score), size=(10, 1), key='_spare_'),
+                   sg.Button('Ok', size=(5, 1), bind_return_key=True)]
+                  ]
+        self.window = sg.Window(title='Cache', layout=layout, keep_on_top=True)
+
+    def read(self):
+        while True:
+            button, values = self.window.Read()
+            if button != 'Ok':
+                return None, None
+            quota = values['_quota_']
+            spare = values['_spare_']
+            if not quota.isdecimal() or not spare.isdecimal():
+                sg.popup_error('invalid value', keep_on_top=True)
+            else:
+                break
+        return int(quota), int(spare)
+
+    def __del__(self):
+        self.window.close()
+        del self.window
+
+
+class FaceDetectWindow:
+    def __init__(self, params):
+        layout = [[sg.Text('Scale factor', size=(15, 1)),
+                   sg.InputText(default_text=str(params['scale_factor']), size=(10, 1), key='scale_factor')],
+                  [sg.Text('Min neighbors', size=(15, 1)),
+                   sg.InputText(default_text=str(params['min_neighbors']), size=(10, 1), key='min_neighbors')],
+                  [sg.Text('Min face size', size=(15, 1)),
+                   sg.InputText(default_text=str(params['min_size']), size=(10, 1), key='min_size')],
+                  [sg.Text('Max image width', size=(15, 1)),
+                   sg.InputText(default_text=str(params['max_width']), size=(10, 1), key='max_width'),
+                   sg.Button('Ok', size=(5, 1), bind_return_key=True)]
+                  ]
+        self.window = sg.Window(title='Face detect', layout=layout, keep_on_top=True)
+
+    def read(self):
+        while True:
+            button, values = self.window.Read()
+            if button != 'Ok':
+                return None
+            try:
+                params = {
+                    'scale_factor': float(values['scale_factor']),
+                    'min_neighbors': int(values['min_neighbors']),
+                    'min_size': int(values['min_size']),
+                    'max_width': int(values['max_width'])
+                }
+            except ValueError:
+                params = None
+            if params is None or params['scale_factor'] <= 1.0:
+                sg.popup_error('invalid parameters', keep_on_top=True)
+            else:
+                return params
+
+    def __del__(self):
+        self.window.close()
+        del self.window
+
+
+class SamplingWindow:
+    def __init__(self, mode, budget):
+        layout = [[sg.Text('Thumbnail sampling', size=(15, 1)),
+                   sg.Combo(sample_modes, default_value=mode, readonly=True, size=(10, 1), key='_mode_')],
+                  [sg.Text('Decode budget', size=(15, 1)),
+                   sg.InputText(default_text=str(budget), size=(10, 1), key='_budget_'),
+                   sg.Button('Ok', size=(5, 1), bind_return_key=True)]
+                  ]
+        self.window = sg.Window(title='Thumbnails', layout=layout, keep_on_top=True)
+
+    def read(self):
+        while True:
+            button, values = self.window.Read()
+            if button != 'Ok':
+                return None, None
+            budget = values['_budget_']
+            if not budget.isdecimal() or int(budget) < small_frame_count:
+                sg.popup_error('budget must be at least %d frames' % small_frame_count, keep_on_top=True)
+            else:
+                break
+        return values['_mode_'], int(budget)
+
+    def __del__(self):
+        self.window.close()
+        del self.window
+
+
+class WatchWindow:
+    def __init__(self, watch):
+        layout = [[sg.Checkbox('Index new and changed videos of these folders', default=watch['enabled'],
+                               key='_enabled_')],
+                  [sg.Multiline(default_text='\n'.join(watch['folders']), size=(60, 6), key='_folders_')],
+                  [sg.Checkbox('Poll instead of inotify, e.g. for network shares', default=watch['polling'],
+                               key='_polling_'),
+                   sg.Button('Ok', size=(5, 1))]
+                  ]
+        self.window = sg.Window(title='Watch folders', layout=layout, keep_on_top=True)
+
+    def read(self):
+        while True:
+            button, values = self.window.Read()
+            if button != 'Ok':
+                return None
+            folders = [line.strip() for line in values['_folders_'].splitlines() if len(line.strip()) > 0]
+            missing = [folder for folder in folders if not os.path.isdir(folder)]
+            if len(missing) > 0:
+                sg.popup_error('not a folder: ' + missing[0], keep_on_top=True)
+            else:
+                return {'enabled': values['_enabled_'], 'folders': folders, 'polling': values['_polling_']}
+
+    def __del__(self):
+        self.window.close()
+        del self.window
+
+
+class PerformanceWindow:
+    headings = ['Name', 'Count', 'Mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'Max ms']
+
+    def __init__(self):
+        layout = [[sg.Checkbox('Record timings', default=perf.enabled, enable_events=True, key='_enabled_')],
+                  [sg.Table(values=self._rows(), headings=self.headings, col_widths=[28, 7, 8, 8, 8, 8, 8],
+                            auto_size_columns=False, num_rows=20, key='_table_')],
+                  [sg.Button('Refresh', size=(8, 1)), sg.Button('Reset', size=(8, 1)),
+                   sg.Button('Export', size=(8, 1)), sg.Button('Ok', size=(5, 1), bind_return_key=True)]
+                  ]
+        self.window = sg.Window(title='Performance', layout=layout, keep_on_top=True)
+
+    @staticmethod
+    def _rows():
+        return [[name, h['count'], '%.2f' % h['mean_ms'], '%.2f' % h['p50_ms'], '%.2f' % h['p90_ms'],
+                 '%.2f' % h['p99_ms'], '%.2f' % h['max_ms']] for name, h in perf.snapshot().items()]
+
+    def read(self):
+        """
+        :return: whether recording is enabled when the window is closed
+        """
+        while True:
+            button, values = self.window.Read()
+            if button == '_enabled_':
+                perf.enable(values['_enabled_'])
+            elif button == 'Reset':
+                perf.reset()
+            elif button == 'Export':
+                file = sg.popup_get_file('Export timings', save_as=True, default_extension='.json',
+                                         file_types=(('JSON', '*.json'),), keep_on_top=True)
+                if file:
+                    perf.export(file)
+            elif button != 'Refresh':
+                return perf.enabled
+            self.window['_table_'].Update(values=self._rows())
+
+    def __del__(self):
+        self.window.close()
+        del self.window
+
+
+class FrameMatchWindow:
+    def __init__(self, results):
+        self.results = results
+        rows = [[distance, '%.1f%%' % pos, path] for distance, path, pos in results]
+        layout = [[sg.Table(values=rows, headings=['Distance', 'Position', 'Path'], col_widths=[8, 8, 60],
+                            auto_size_columns=False, num_rows=min(len(rows), 20),
+                            select_mode=sg.TABLE_SELECT_MODE_BROWSE, key='_table_')],
+                  [sg.Button('Ok', size=(5, 1), bind_return_key=True)]
+                  ]
+        self.window = sg.Window(title='Similar frames', layout=layout, keep_on_top=True)
+
+    def read(self):
+        button, values = self.window.Read()
+        if button != 'Ok' or len(values['_table_']) == 0:
+            return None, None
+        _, path, pos = self.results[values['_table_'][0]]
+        return path, pos
+
+    def __del__(self):
+        self.window.close()
+        del self.window
+
+
 class VideoPlayer:
     def __init__(self):
         graph_col = [
@@ -168,13 +341,16 @@ class VideoPlayer:
         layout = [
             [
                 sg.Menu([
-                    ['&File', ['Open Folder', 'Close all']],
-                    ['&Edit', ['&Detect face', '&Mark', 'Open container folder',
-                               'List not exists', 'List same names', 'List key words',
-                               '&Remove selected', 'Modify selected directory']
+                    ['&File', ['Open Folder', 'Scan libraries', 'Close all']],
+                    ['&Edit', ['&Detect face', 'Find similar frames', '&Mark', 'Open container folder',
+                               'List not exists', 'List same names', 'List duplicates', 'List visually similar',
+                               'List more like this', 'List key words',
+                               '&Remove selected', 'Modify selected directory', 'Clean cache', 'Index faces']
                      ],
-                    ['&History', ['All::load_all', 'Marked::load_marked']],
-                    ['&Settings', ['Face detect']]
+                    ['&History', ['All::load_all', 'Marked::load_marked', 'With faces::load_faces',
+                                  'By motion::load_motion',
+                                  'Sort by', ['%s::sort_%s' % (label, order) for order, label in history_orders.items()]]],
+                    ['&Settings', ['Face detect', 'Thumbnails', 'Cache quota', 'Watch folders', 'Performance']]
                 ])
             ],
             [
@@ -183,10 +359,14 @@ class VideoPlayer:
             ]
         ]
         self.window = sg.Window('Video Player', layout, return_keyboard_events=True,
-                                use_default_focus=False, resizable=False)
+                                use_default_focus=False, resizable=False, finalize=True)
         self.graph = self.window['graph']
+        # a grid of 4 x 3 small frames, drawn from the closest cached thumbnail size
+        self.thumbnail_width = self.graph.CanvasSize[0] // 4
         self.event_dispatch = {
             'Open Folder': self._handle_open_folder,
+            'Scan libraries': self._handle_scan_libraries,
+            'libraries_scanned': self._handle_libraries_scanned,
             'Open container folder': self._handle_open_container_folder,
             'Close all': self._handle_close_all,
             'All::load_all': self._handle_load_all,
@@ -196,38 +376,211 @@ class VideoPlayer:
             'Play': self._handle_play_video,
             'Detect face': self._handle_detect_face,
             'Remove selected': self._handle_file_remove,
+            'files_removed': self._handle_files_removed,
             'Modify selected directory': self._handle_modify_directory,
+            'directory_modified': self._handle_directory_modified,
             'List not exists': self._handle_list_not_exists,
             'List same names': self._handle_list_same_names,
+            'List duplicates': self._handle_list_duplicates,
+            'duplicates_found': self._handle_duplicates_found,
+            'List visually similar': self._handle_list_similar,
+            'similar_found': self._handle_duplicates_found,
             'List key words': self._handle_list_key_words,
-            'slider': self._handle_slider_move
+            'slider': self._handle_slider_move,
+            'Clean cache': self._handle_clean_cache,
+            'cache_collected': self._handle_cache_collected,
+            'Cache quota': self._handle_cache_quota,
+            'Find similar frames': self._handle_find_similar_frames,
+            'similar_frames_found': self._handle_similar_frames_found,
+            'Index faces': self._handle_index_faces,
+            'faces_indexed': self._handle_faces_indexed,
+            'With faces::load_faces': self._handle_load_faces,
+            'By motion::load_motion': self._handle_load_motion,
+            'Face detect': self._handle_face_detect_settings,
+            'faces_detected': self._handle_faces_detected,
+            'Thumbnails': self._handle_sampling_settings,
+            'Performance': self._handle_performance,
+            'Watch folders': self._handle_watch_settings,
+            'List more like this': self._handle_list_more_like_this,
+            'more_like_this_found': self._handle_more_like_this_found,
+            'files_loaded': self._update_file_list,
+            'history_page': self._handle_history_page,
+            'session_revalidated': self._handle_session_revalidated,
+            'folder_found': self._handle_folder_found,
+            'video_loaded': self._handle_video_loaded,
+            'frame_grabbed': self._handle_frame_grabbed,
+            task_done_event: self._handle_task_done
         }
+        for order, label in history_orders.items():
+            self.event_dispatch['%s::sort_%s' % (label, order)] = lambda order=order: self._handle_sort_history(order)
+        self.tasks = TaskRunner(self.window)
+        # the history is listed a page at a time, the next page is loaded when scrolling near the end
+        self.history = None
+        self.history_order = Repository(cache_repo).get_setting('history_order', 'added')
+        self.list_scroll = 0.0
+        # the last session while it is being restored
+        self.restore = None
+        listbox = self.window['listbox']
+        listbox.Widget.configure(yscrollcommand=self._handle_list_scrolled)
         self.selected_video = None
+        self.frame_index = FrameIndex()
+        self.colour_index = ColourIndex()
+        self.face_indexer = None
+        self.watcher = None
+        self.scheduler = None
+        self.face_boxes = OrderedDict()
+        self.face_figures = []
 
     def run(self):
+        # paint the window before anything else, the indexer and its imports of cv2 and numpy come after
+        self.window.refresh()
+        if perf.enabled:
+            perf.record('startup/first_paint', time.perf_counter() - _started)
+        self._restore_session()
+        video_processor()
+        self._start_watcher()
+        # scans the library roots on their schedule and keeps track of unmounted ones
+        self.scheduler = LibraryScheduler()
+        self.scheduler.start()
         while True:
             event, values = self.window.read()
             # print(event, values)
             if event is None:
                 break
             elif event in self.event_dispatch:
-                if event in values:
-                    self.event_dispatch[event](values[event])
-                else:
-                    self.event_dispatch[event]()
+                with perf.timer('event/' + str(event)):
+                    if event in values:
+                        self.event_dispatch[event](values[event])
+                    else:
+                        self.event_dispatch[event]()
 
+        self._save_session()
+        if self.face_indexer is not None:
+            self.face_indexer.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.tasks.close()
         self.window.close()
 
+    def _save_session(self):
+        """
+        a history view is saved as its query, any other list as its compressed paths
+        """
+        files = self.window['listbox'].Values
+        session = {
+            'history': None,
+            'files': None,
+            'selected': self.selected_video.path if self.selected_video is not None else None,
+            'scroll': self.list_scroll
+        }
+        if self.history is not None:
+            session['history'] = {
+                'order': self.history['order'],
+                'lower': self.history['lower'],
+                'upper': self.history['upper'],
+                'rows': len(files)
+            }
+        else:
+            session['files'] = _pack_paths(files)
+        Repository(cache_repo).set_setting('session', session)
+
+    def _restore_session(self):
+        """
+        show the list of the last session from the repository alone, the files are checked in the background
+        """
+        session = Repository(cache_repo).get_setting('session')
+        if session is None:
+            return
+        self.restore = session
+        if session['history'] is not None:
+            history = session['history']
+            self.history_order = history['order']
+            self._load_history(history['lower'], history['upper'], max(history['rows'], history_page_size))
+        else:
+            self._update_file_list(_unpack_paths(session['files']))
+            self._apply_restore()
+
+    def _apply_restore(self):
+        session = self.restore
+        self.restore = None
+        listbox = self.window['listbox']
+        files = listbox.Values
+        if session['selected'] is not None and session['selected'] in files:
+            listbox.Update(set_to_index=files.index(session['selected']))
+            self._select_video(session['selected'])
+        listbox.Widget.yview_moveto(session['scroll'])
+        if len(files) == 0:
+            return
+
+        def revalidate():
+            exists = ExistenceScanner().check(files)
+            return files, len([file for file in files if not exists.get(file, True)])
+
+        self.tasks.submit('revalidate', revalidate, 'session_revalidated')
+
+    def _handle_session_revalidated(self, result):
+        files, missing = result
+        # the count is of the restored list, another list may have been loaded meanwhile
+        if self.window['listbox'].Values != files:
+            return
+        if missing > 0:
+            print('%d files of the restored list are missing' % missing)
+            self.window['total_count'].Update('%s, %d missing' % (self.window['total_count'].DisplayText, missing))
+
+    def _handle_task_done(self, done):
+        done = self.tasks.take(done)
+        if done is None:
+            return
+        event, result = done
+        self.event_dispatch[event](result)
+
     def _handle_open_folder(self):
         items = self.window['listbox'].GetListValues()
         folder = sg.popup_get_folder('Folder to open', default_path='')
-        if folder:
-            files = MediaFinder(folder).find_all()
-            for file in files:
-                if file not in items:
-                    items.append(file)
-                    _video_processor.process(file)
-        self._update_file_list(items)
+        if not folder:
+            return
+
+        def find(task):
+            known = set(items)
+            new_files = []
+            for file in MediaFinder(folder).iter_files():
+                if task.cancelled():
+                    return None
+                if file not in known:
+                    known.add(file)
+                    new_files.append(file)
+            video_processor().process_all(new_files)
+            return items + new_files
+
+        self.tasks.submit('list', find, 'folder_found', cancellable=True)
+
+    def _handle_folder_found(self, files):
+        if files is not None:
+            self._update_file_list(files)
+
+    def _handle_scan_libraries(self):
+        def scan():
+            library = Library()
+            library.check()
+            jobs = JobQueue()
+            stats = {'found': 0, 'offline': 0}
+            for root in library.roots:
+                found = library.scan(root, jobs)
+                if found is None:
+                    stats['offline'] += 1
+                else:
+                    stats['found'] += found
+            jobs.close()
+            # wakes the indexer up for the new jobs
+            video_processor().process_all([])
+            return stats
+
+        self.tasks.submit('libraries', scan, 'libraries_scanned')
+
+    def _handle_libraries_scanned(self, stats):
+        print('queued %d videos of the library roots, %d roots offline' % (stats['found'], stats['offline']))
 
     def _handle_open_container_folder(self):
         if self.selected_video is not None:
@@ -239,13 +592,18 @@ class VideoPlayer:
             os.startfile(path)
 
     def _handle_list_not_exists(self):
-        listbox = self.window['listbox']
-        files = listbox.GetListValues()
-        not_exists = []
-        for file in files:
-            if not os.path.exists(file):
-                not_exists.append(file)
-        self._update_file_list(not_exists)
+        files = self.window['listbox'].GetListValues()
+
+        def find(task):
+            # the files found missing before show up at once, the fresh check replaces them
+            missing = Repository(cache_repo).find_missing()
+            if len(missing) > 0:
+                listed = set(files)
+                task.post('files_loaded', [file for file in missing if file in listed])
+            exists = ExistenceScanner().check(files, task.cancelled)
+            return [file for file in files if not exists.get(file, True)]
+
+        self.tasks.submit('list', find, 'files_loaded', cancellable=True)
 
     def _handle_list_same_names(self):
         listbox = self.window['listbox']
@@ -263,6 +621,39 @@ class VideoPlayer:
                 files_with_same_name += paths
         self._update_file_list(files_with_same_name)
 
+    def _handle_list_duplicates(self):
+        files = self.window['listbox'].GetListValues()
+        self.tasks.submit('list', lambda: DuplicateFinder().find(files), 'duplicates_found')
+
+    def _handle_duplicates_found(self, groups):
+        files = []
+        for group in groups:
+            files += group
+        self._update_file_list(files)
+
+    def _handle_list_similar(self):
+        files = self.window['listbox'].GetListValues()
+        self.tasks.submit('list', lambda: SimilarFinder().find(files), 'similar_found')
+
+    def _handle_list_more_like_this(self):
+        if self.selected_video is None:
+            return
+        uid = self.selected_video.uid
+        path = self.selected_video.path
+
+        def query():
+            rcd = Repository(cache_repo).find_by_uuid(uid)
+            if rcd is None or not rcd['has_colour']:
+                # never decoded or skipped, there is nothing to compare and nothing to rebuild
+                return [path]
+            self.colour_index.refresh(force=uid not in self.colour_index.uids)
+            return [path] + [other for _, other in self.colour_index.query(uid)]
+
+        self.tasks.submit('list', query, 'more_like_this_found')
+
+    def _handle_more_like_this_found(self, files):
+        self._update_file_list(files)
+
     def _handle_list_key_words(self):
         words = sg.PopupGetText('Input the key words', title='Input', keep_on_top=True)
         if words is None or len(words) == 0:
@@ -279,19 +670,105 @@ class VideoPlayer:
     def _handle_close_all(self):
         self.window['slider'].Update(1)
         self.window['graph'].Erase()
+        self.face_figures = []
         self.selected_video = None
         self._update_file_list([])
 
+    def _load_history(self, lower=None, upper=None, first_page=history_page_size):
+        order = self.history_order
+        self.history = {
+            'order': order,
+            'descending': order != 'path',
+            'lower': lower,
+            'upper': upper,
+            'after': None,
+            'total': None,
+            'done': False,
+            'loading': False,
+            'limit': first_page
+        }
+        self._load_history_page()
+
+    def _load_history_page(self):
+        history = self.history
+        if history is None or history['done'] or history['loading']:
+            return
+        history['loading'] = True
+        after = history['after']
+
+        def load():
+            try:
+                repo = Repository(cache_repo)
+                total = repo.count(history['lower'], history['upper']) if after is None else None
+                page = repo.find_page(history['order'], history['descending'], after, history['limit'],
+                                      history['lower'], history['upper'])
+            except Exception as e:
+                print('failed to load history: %s' % e)
+                # the handler clears the loading flag, scrolling tries the page again
+                return history, None, None
+            return history, total, page
+
+        self.tasks.submit('list', load, 'history_page')
+
+    def _handle_history_page(self, result):
+        history, total, page = result
+        if history is not self.history:
+            return
+        if page is None:
+            history['loading'] = False
+            return
+        paths = [path for _, path in page]
+        listbox = self.window['listbox']
+        if history['after'] is None:
+            history['total'] = total
+            listbox.Update(paths)
+        else:
+            listbox.Values.extend(paths)
+            listbox.Widget.insert('end', *paths)
+        history['loading'] = False
+        history['done'] = len(page) < history['limit']
+        history['limit'] = history_page_size
+        if len(page) > 0:
+            history['after'] = page[-1][0]
+        self.window['total_count'].Update('%d/%d' % (len(listbox.Values), history['total']))
+        if self.restore is not None:
+            self._apply_restore()
+
+    def _handle_list_scrolled(self, first, last):
+        self.window['listbox'].vsb.set(first, last)
+        self.list_scroll = float(first)
+        if float(last) > 0.9:
+            self._load_history_page()
+
+    def _handle_sort_history(self, order):
+        self.history_order = order
+        Repository(cache_repo).set_setting('history_order', order)
+        if self.history is not None:
+            self._load_history(self.history['lower'], self.history['upper'])
+
+    def _load_files(self, find):
+        """
+        :param find: called with the repository, returns the records to list
+        """
+        self.tasks.submit('list', lambda: [file['path'] for file in find(Repository(cache_repo))], 'files_loaded')
+
     def _handle_load_all(self):
-        repo = Repository(cache_repo)
-        files = repo.find_all()
-        self._update_file_list([file['path'] for file in files])
+        self._load_history()
 
     def _handle_load_marked(self):
         lower, upper = SelectByScoreWindow().read()
-        repo = Repository(cache_repo)
-        files = repo.find_with_score(lower, upper)
-        self._update_file_list([file['path'] for file in files])
+        if lower is None:
+            return
+        self._load_history(lower, upper)
+
+    def _handle_load_faces(self):
+        self._load_files(lambda repo: repo.find_with_faces())
+
+    def _handle_load_motion(self):
+        lower, upper = SelectByScoreWindow('motion range', 0, 100).read()
+        if lower is None:
+            return
+        self._load_files(lambda repo: repo.find_with_motion(lower, upper))
 
     def _handle_mark(self):
         if self.selected_video is not None:
@@ -304,23 +781,58 @@ class VideoPlayer:
         files = listbox.GetListValues()
         selected = listbox.get()
         for file in selected:
-            VideoFile(file).delete_cache()
             files.remove(file)
         self._update_file_list(files)
 
+        def remove(paths):
+            for path in paths:
+                VideoFile(path).delete_cache()
+            return len(paths)
+
+        self.tasks.submit_batch('remove', selected, remove, 'files_removed')
+
+    def _handle_files_removed(self, count):
+        print('removed %d videos and their caches' % count)
+
     def _update_file_list(self, files):
+        self.history = None
         self.window['listbox'].Update(files)
         self.window['total_count'].Update(str(len(files)))
 
     def _handle_file_selected(self, files):
         if len(files) is 0:
             return
-        path = files[0]
-        if self.selected_video is None or self.selected_video.path is not path:
-            self.selected_video = VideoFile(path)
-            if self.selected_video.is_cache_exist():
-                self.selected_video.load_cache()
-        self._display_small_graphs()
+        self._select_video(files[0])
+
+    def _select_video(self, path, pos=None):
+        """
+        load the video on a worker, then show its small frames or the frame at pos
+        """
+        if self.selected_video is not None and self.selected_video.path == path:
+            self._handle_video_loaded((self.selected_video, pos))
+            return
+
+        width = self.thumbnail_width
+
+        def load():
+            video = VideoFile(path)
+            if video.is_cache_exist():
+                video.load_cache()
+                video.get_thumbnails(width)
+            return video, pos
+
+        # a frame still being grabbed belongs to the previous video
+        self.tasks.cancel('frame')
+        self.tasks.submit('video', load, 'video_loaded')
+
+    def _handle_video_loaded(self, result):
+        video, pos = result
+        self.selected_video = video
+        if pos is None:
+            self._display_small_graphs()
+        else:
+            self.window['slider'].Update(pos)
+            self._display_video(pos)
 
     def _handle_modify_directory(self):
         src, dst = DirectoryChangeWindow().read()
@@ -330,15 +842,25 @@ class VideoPlayer:
         listbox = self.window['listbox']
         files = listbox.GetListValues()
         selected = listbox.get()
+        moves = []
         for file in selected:
             if file.startswith(src):
                 i = files.index(file)
                 new_file = file.replace(src, dst, 1)
                 print('change file %d from %s to %s' % (i, file, new_file))
                 files[i] = new_file
-                VideoFile(file).modify_path(new_file)
+                moves.append((file, new_file))
         self._update_file_list(files)
-        return
+
+        def modify(batch):
+            for file, new_file in batch:
+                VideoFile(file).modify_path(new_file)
+            return len(batch)
+
+        self.tasks.submit_batch('modify', moves, modify, 'directory_modified')
+
+    def _handle_directory_modified(self, count):
+        print('changed the directory of %d videos' % count)
 
     def _handle_play_video(self):
         if self.selected_video is None or not self.selected_video.is_file_exist():
@@ -347,22 +869,39 @@ class VideoPlayer:
         os.startfile(self.selected_video.path)
 
     def _display_video(self, pos=None):
-        if self.selected_video is None or not self.selected_video.is_file_exist():
+        video = self.selected_video
+        if video is None:
+            return
+
+        def grab():
+            if not video.is_file_exist():
+                return video, None, False
+            return video, video.grab_frame(pos), True
+
+        self.tasks.submit('frame', grab, 'frame_grabbed')
+
+    @perf.timed('draw/frame')
+    def _handle_frame_grabbed(self, result):
+        video, frame, exists = result
+        if video is not self.selected_video:
+            return
+        if not exists:
             sg.popup_error('file not exists', keep_on_top=True)
             return
         self.graph.Erase()
-        frame = self.selected_video.grab_frame(pos)
+        self.face_figures = []
         if frame is not None:
             self.graph.DrawImage(data=frame, location=(0, 480))
         self.graph.DrawText(self.selected_video.path, location=(0, 500), color='white',
                             text_location=sg.TEXT_LOCATION_TOP_LEFT)
 
+    @perf.timed('draw/small_frames')
     def _display_small_graphs(self):
         if self.selected_video is None:
             return
-        frames = self.selected_video.get_small_frames()
+        frames = self.selected_video.get_thumbnails(self.thumbnail_width)
         self.graph.Erase()
-        size = small_frame_size
+        self.face_figures = []
         for j in range(0, 3):
             for i in range(0, 4):
                 index = j * 4 + i
@@ -370,8 +909,8 @@ class VideoPlayer:
                     break
                 frame = frames[index]
                 if frame is not None:
-                    width = size[0]
-                    height = size[1]
+                    width = self.thumbnail_width
+                    height = width * small_frame_size[1] // small_frame_size[0]
                     self.graph.DrawImage(data=frame,  location=(i * width + 10, 480 - j * (height + 10)))
 
         self.graph.DrawText(self.selected_video.path, location=(0, 500), color='white',
@@ -380,19 +919,142 @@ class VideoPlayer:
     def _handle_slider_move(self, pos):
         self._display_video(pos)
 
-    def _handle_detect_face(self):
+    def _handle_clean_cache(self):
+        def collect():
+            stats = CacheManager().collect()
+            video_processor().process_all(stats['missing'], reset=True)
+            return stats
+
+        self.tasks.submit('cache', collect, 'cache_collected')
+
+    def _handle_cache_collected(self, stats):
+        sg.popup('Removed %d orphan caches, evicted %d caches, freed %.1f MB.\n'
+                 'Cache size %.1f MB, %d missing caches queued.' %
+                 (stats['orphan_files'], stats['evicted'], stats['freed'] / 1024 / 1024,
+                  stats['total'] / 1024 / 1024, len(stats['missing'])),
+                 title='Clean cache', keep_on_top=True)
+
+    def _handle_cache_quota(self):
+        repo = Repository(cache_repo)
+        quota = repo.get_setting('cache_quota', cache_manager.default_quota)
+        spare = repo.get_setting('cache_spare_score', cache_manager.default_spare_score)
+        quota, spare = CacheQuotaWindow(quota // 1024 // 1024, spare).read()
+        if quota is None:
+            return
+        repo.set_setting('cache_quota', quota * 1024 * 1024)
+        repo.set_setting('cache_spare_score', spare)
+
+    def _handle_find_similar_frames(self):
         if self.selected_video is None or self.selected_video.get_cur_cv_frame() is None:
+            sg.popup_error('move the slider to a frame first', keep_on_top=True)
             return
         frame = self.selected_video.get_cur_cv_frame()
-        fd = FaceDetect()
-        num = fd.detect(frame)
-        if num > 0:
-            img_bytes = cv2.imencode('.png', frame)[1].tobytes()
-            self.graph.DrawImage(data=img_bytes, location=(10, 480))
+        uid = self.selected_video.uid
+
+        def query():
+            self.frame_index.refresh()
+            return self.frame_index.query(frame, exclude=uid)
+
+        self.tasks.submit('similar_frames', query, 'similar_frames_found')
+
+    def _handle_similar_frames_found(self, results):
+        if len(results) == 0:
+            sg.popup('No similar frames found', keep_on_top=True)
+            return
+        path, pos = FrameMatchWindow(results).read()
+        if path is None:
+            return
+        self._select_video(path, pos)
+
+    def _handle_index_faces(self):
+        if self.face_indexer is not None and self.face_indexer.is_alive():
+            sg.popup('Face indexing is running', keep_on_top=True)
+            return
+        self.face_indexer = FaceIndexer(on_done=lambda stats: self.window.write_event_value('faces_indexed', stats))
+        self.face_indexer.start()
+
+    def _handle_faces_indexed(self, stats):
+        per_frame = stats['seconds'] * 1000 / stats['frames'] if stats['frames'] > 0 else 0
+        sg.popup('Indexed %d videos, %d with faces, %.2f ms per frame' %
+                 (stats['videos'], stats['with_faces'], per_frame), title='Index faces', keep_on_top=True)
+
+    def _handle_sampling_settings(self):
+        repo = Repository(cache_repo)
+        mode, budget = SamplingWindow(repo.get_setting('sample_mode', default_sample_mode),
+                                      repo.get_setting('sample_budget', default_sample_budget)).read()
+        if mode is None:
+            return
+        repo.set_setting('sample_mode', mode)
+        repo.set_setting('sample_budget', budget)
+
+    def _start_watcher(self):
+        watch = Repository(cache_repo).get_setting('watch', default_watch)
+        if not watch['enabled'] or len(watch['folders']) == 0:
+            return
+        # the watcher queues jobs, the indexer picks them up
+        self.watcher = LibraryWatcher(watch['folders'], polling=watch['polling'])
+        self.watcher.start()
+
+    def _handle_watch_settings(self):
+        repo = Repository(cache_repo)
+        watch = WatchWindow(repo.get_setting('watch', default_watch)).read()
+        if watch is None:
+            return
+        repo.set_setting('watch', watch)
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self._start_watcher()
+
+    def _handle_performance(self):
+        Repository(cache_repo).set_setting('perf_enabled', PerformanceWindow().read())
+
+    def _handle_face_detect_settings(self):
+        repo = Repository(cache_repo)
+        params = FaceDetectWindow(repo.get_setting('face_detect', default_params)).read()
+        if params is not None:
+            repo.set_setting('face_detect', params)
+
+    def _handle_detect_face(self):
+        video = self.selected_video
+        if video is None or video.get_cur_cv_frame() is None:
+            return
+        if len(self.face_figures) > 0:
+            for figure in self.face_figures:
+                self.graph.DeleteFigure(figure)
+            self.face_figures = []
+            return
+        key = (video.uid, video.cur_pos)
+        if key in self.face_boxes:
+            self.face_boxes.move_to_end(key)
+            self._draw_faces(self.face_boxes[key])
+            return
+        frame = video.get_cur_cv_frame()
+        params = Repository(cache_repo).get_setting('face_detect', default_params)
+        self.tasks.submit('faces', lambda: (key, FaceDetect(**params).find(frame)), 'faces_detected')
+
+    def _handle_faces_detected(self, result):
+        key, boxes = result
+        if key[1] is not None:
+            # frames grabbed without a position can not be found again
+            self.face_boxes[key] = boxes
+            if len(self.face_boxes) > 256:
+                self.face_boxes.popitem(last=False)
+        video = self.selected_video
+        if video is None or (video.uid, video.cur_pos) != key:
+            return
+        self._draw_faces(boxes)
+
+    def _draw_faces(self, boxes):
+        # the frame is drawn with its top left corner at (0, 480)
+        for (x, y, w, h) in boxes:
+            figure = self.graph.DrawRectangle((x, 480 - y), (x + w, 480 - y - h), line_color='white', line_width=2)
+            self.face_figures.append(figure)
 
 
 if __name__ == '__main__':
     os.chdir("../workdir/")  
-    _video_processor.start()
+    perf.enable(Repository(cache_repo).get_setting('perf_enabled', False))
     VideoPlayer().run()
-    _video_processor.stop()
+    if _video_processor is not None:
+        _video_processor.stop()
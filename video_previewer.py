@@ -0,0 +1,321 @@
+"""
+Headless entry point, indexes libraries into the same cache layout the GUI reads.
+
+    python -m video_previewer [--workdir DIR] [--perf FILE] index FOLDER [FOLDER ...] [--workers N] [--mode fixed|scene]
+    python -m video_previewer [--workdir DIR] rescan [--workers N] [--force]
+    python -m video_previewer [--workdir DIR] resume [--workers N] [--mode fixed|scene]
+    python -m video_previewer [--workdir DIR] watch FOLDER [FOLDER ...] [--workers N] [--debounce S] [--poll]
+    python -m video_previewer [--workdir DIR] library add NAME PATH [--suffix S ...] [--exclude GLOB ...] [--schedule HOURS]
+    python -m video_previewer [--workdir DIR] library list|remove NAME|scan [NAME ...]
+    python -m video_previewer [--workdir DIR] gc [--quota MB]
+    python -m video_previewer [--workdir DIR] stats
+
+Jobs are persisted in the repository, an interrupted run continues with resume, which can also be
+started on several hosts sharing the work dir. watch indexes the folders and then keeps indexing
+new and modified videos until interrupted, and meanwhile scans the library roots on their schedule.
+index, rescan and resume also take --device-readers N to cap the concurrent reads per spinning disk
+or network share, and --read-ahead. Relative paths are relative to the current folder, not to the
+work dir. The exit code is 0 on success and 1 if any video failed.
+"""
+import sys
+import argparse
+import threading
+from video_file import *
+from video_process import MediaFinder, VideoProcess
+from job_queue import JobQueue
+from library import Library, LibraryScheduler, new_root
+from library_watcher import LibraryWatcher, default_debounce, default_poll_interval
+from cache_manager import CacheManager
+from utils import perf
+
+metrics_interval = 10
+put_batch_size = 500
+
+
+class _Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, path, ok):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            rate = self.done / max(time.time() - self.start, 1e-6)
+            print('[%d/%d] %s %s (%.1f videos/s)' % (self.done, self.total, 'ok' if ok else 'FAILED', path, rate),
+                  flush=True)
+
+
+def _process_all(paths, args, mode=None, force=False, reset=False):
+    jobs = JobQueue()
+    jobs.put(paths, reset)
+    return _work(jobs, args, mode, force)
+
+
+def _work(jobs, args, mode=None, force=False):
+    # the header counts the jobs still offline, not the ones parked while their root was away
+    Library().check()
+    counts = jobs.counts()
+    print('%d pending, %d running, %d done, %d failed, %d offline jobs' %
+          (counts['pending'], counts['running'], counts['done'], counts['failed'], counts['offline']))
+    progress = _Progress(counts['pending'])
+    processor = VideoProcess(workers=args.workers, mode=mode, force=force, on_done=progress, exit_when_idle=True,
+                             device_readers=args.device_readers, read_ahead=args.read_ahead or None)
+    processor.start()
+    while True:
+        processor.join(metrics_interval)
+        metrics = processor.metrics.snapshot()
+        if not processor.is_alive():
+            break
+        print('queues %s, %.1f MB frames in flight' % (metrics['queue_depth'], metrics['bytes_in_flight'] / 1024 / 1024),
+              flush=True)
+    print('processed %d videos, %d failed in %.1fs, peak %.1f MB frames in flight' %
+          (progress.done, progress.failed, time.time() - progress.start, metrics['peak_bytes_in_flight'] / 1024 / 1024))
+    return 1 if progress.failed > 0 else 0
+
+
+def _queue_folders(jobs, folders):
+    """
+    :return: number of videos found
+    """
+    found = 0
+    batch = []
+    for folder in folders:
+        # queue while walking, so a huge library never sits in memory as one list
+        for path in MediaFinder(folder).iter_files():
+            batch.append(path)
+            if len(batch) >= put_batch_size:
+                jobs.put(batch)
+                found += len(batch)
+                batch = []
+    jobs.put(batch)
+    found += len(batch)
+    print('found %d videos' % found)
+    return found
+
+
+def _check_folders(folders):
+    for folder in folders:
+        if not os.path.isdir(folder):
+            print('not a folder: ' + folder)
+            return False
+    return True
+
+
+def _index(args):
+    if not _check_folders(args.folders):
+        return 1
+    jobs = JobQueue()
+    _queue_folders(jobs, args.folders)
+    return _work(jobs, args, args.mode)
+
+
+def _watch(args):
+    if not _check_folders(args.folders):
+        return 1
+    _queue_folders(JobQueue(), args.folders)
+
+    def report(path, ok):
+        print('%s %s' % ('ok' if ok else 'FAILED', path), flush=True)
+
+    processor = VideoProcess(workers=args.workers, mode=args.mode, on_done=report,
+                             device_readers=args.device_readers, read_ahead=args.read_ahead or None)
+    watcher = LibraryWatcher(args.folders, debounce=args.debounce, poll_interval=args.poll_interval,
+                             polling=args.poll)
+    scheduler = LibraryScheduler()
+    processor.start()
+    watcher.start()
+    scheduler.start()
+    print('watching %d folders, press Ctrl+C to stop' % len(args.folders), flush=True)
+    try:
+        while processor.is_alive():
+            processor.join(metrics_interval)
+    except KeyboardInterrupt:
+        pass
+    scheduler.stop()
+    watcher.stop()
+    processor.stop()
+    return 0
+
+
+def _library_add(args):
+    if not os.path.isdir(args.path):
+        print('not a folder: ' + args.path)
+        return 1
+    before = Library().find(args.name)
+    root = new_root(args.name, args.path, suffixes=args.suffix, excludes=args.exclude or [],
+                    schedule=args.schedule * 3600 if args.schedule else None, workers=args.workers,
+                    read_ahead=True if args.read_ahead else None)
+    if before is not None and before['path'] == root['path']:
+        root['last_scan'] = before['last_scan']
+    Repository(cache_repo).save_root(root)
+    print('%s library root %s at %s' % ('updated' if before is not None else 'added', root['name'], root['path']))
+    return 0
+
+
+def _library_remove(args):
+    if Library().find(args.name) is None:
+        print('no library root ' + args.name)
+        return 1
+    Repository(cache_repo).delete_root(args.name)
+    return 0
+
+
+def _library_list(args):
+    library = Library()
+    library.check()
+    for root in sorted(library.roots, key=lambda root: root['name']):
+        schedule = '%gh' % (root['schedule'] / 3600) if root['schedule'] else 'manual'
+        last_scan = time.strftime('%Y-%m-%d %H:%M', time.localtime(root['last_scan'])) if root['last_scan'] else 'never'
+        print('%-16s %-8s %-8s scanned %s  %s' % (root['name'], 'offline' if root['offline'] else 'online', schedule,
+                                                 last_scan, root['path']))
+        for key in ['suffixes', 'excludes', 'workers', 'read_ahead']:
+            if root[key]:
+                print('%16s %s: %s' % ('', key, root[key]))
+    return 0
+
+
+def _library_scan(args):
+    library = Library()
+    for name in args.names:
+        if library.find(name) is None:
+            print('no library root ' + name)
+            return 1
+    library.check()
+    jobs = JobQueue()
+    for root in library.roots:
+        if len(args.names) > 0 and root['name'] not in args.names:
+            continue
+        found = library.scan(root, jobs)
+        if found is None:
+            print('skip offline library root ' + root['name'])
+        else:
+            print('found %d videos in library root %s' % (found, root['name']))
+    return _work(jobs, args, args.mode)
+
+
+def _rescan(args):
+    paths = [rcd['path'] for rcd in Repository(cache_repo).find_all()]
+    paths = [path for path in paths if os.path.exists(path)]
+    print('rescan %d existing videos' % len(paths))
+    return _process_all(paths, args, force=args.force, reset=True)
+
+
+def _resume(args):
+    return _work(JobQueue(), args, args.mode)
+
+
+def _gc(args):
+    quota = args.quota * 1024 * 1024 if args.quota is not None else None
+    stats = CacheManager(quota=quota, pause=0).collect()
+    print('removed %d orphan caches, evicted %d caches, freed %.1f MB, cache size %.1f MB' %
+          (stats['orphan_files'], stats['evicted'], stats['freed'] / 1024 / 1024, stats['total'] / 1024 / 1024))
+    for path in stats['missing']:
+        print('missing cache: ' + path)
+    return 0
+
+
+def _stats(args):
+    for key, value in Repository(cache_repo).stats().items():
+        print('%-14s %d' % (key, value))
+    return 0
+
+
+def _add_io_arguments(parser):
+    parser.add_argument('--device-readers', type=int,
+                        help='concurrent reads per spinning disk or network share, 0 for no limit, '
+                             'the saved setting by default')
+    parser.add_argument('--read-ahead', action='store_true', help='prefetch the head and tail of each file')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='video_previewer', description='Index video libraries without the GUI')
+    parser.add_argument('--workdir', help='folder holding %s and %s' % (cache_repo, cache_dir))
+    parser.add_argument('--perf', metavar='FILE', help='record stage timings and write them to FILE as json')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    index = commands.add_parser('index', help='find videos in folders and cache their small frames')
+    index.add_argument('folders', nargs='+')
+    index.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    _add_io_arguments(index)
+    index.add_argument('--mode', choices=sample_modes, help='thumbnail sampling, the saved setting by default')
+    index.set_defaults(func=_index)
+
+    rescan = commands.add_parser('rescan', help='index every existing video of the repository again')
+    rescan.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    _add_io_arguments(rescan)
+    rescan.add_argument('--force', action='store_true', help='grab the small frames even if they are cached')
+    rescan.set_defaults(func=_rescan)
+
+    resume = commands.add_parser('resume', help='work on the queued jobs, several hosts may share the queue')
+    resume.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    _add_io_arguments(resume)
+    resume.add_argument('--mode', choices=sample_modes, help='thumbnail sampling, the saved setting by default')
+    resume.set_defaults(func=_resume)
+
+    watch = commands.add_parser('watch', help='index folders and keep indexing their changes until interrupted')
+    watch.add_argument('folders', nargs='+')
+    watch.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    _add_io_arguments(watch)
+    watch.add_argument('--mode', choices=sample_modes, help='thumbnail sampling, the saved setting by default')
+    watch.add_argument('--debounce', type=float, default=default_debounce,
+                       help='seconds a file has to stay unchanged before it is queued')
+    watch.add_argument('--poll', action='store_true', help='walk the folders instead of using inotify')
+    watch.add_argument('--poll-interval', type=float, default=default_poll_interval,
+                       help='seconds between walks when polling')
+    watch.set_defaults(func=_watch)
+
+    library = commands.add_parser('library', help='named library roots with their own scan policies')
+    library_commands = library.add_subparsers(dest='library_command', required=True)
+    add = library_commands.add_parser('add', help='add a root or replace its settings')
+    add.add_argument('name')
+    add.add_argument('path')
+    add.add_argument('--suffix', action='append', help='video file suffix, repeat for several, the usual ones by default')
+    add.add_argument('--exclude', action='append', help='glob of files or folders to skip, repeat for several')
+    add.add_argument('--schedule', type=float, help='hours between scans while a watch or the GUI runs')
+    add.add_argument('--workers', type=int, help='concurrent decodes of the videos of this root')
+    add.add_argument('--read-ahead', action='store_true', help='prefetch the head and tail of each file')
+    add.set_defaults(func=_library_add)
+    remove = library_commands.add_parser('remove', help='forget a root, its videos stay in the repository')
+    remove.add_argument('name')
+    remove.set_defaults(func=_library_remove)
+    listing = library_commands.add_parser('list', help='list the roots and whether they are mounted')
+    listing.set_defaults(func=_library_list)
+    scan = library_commands.add_parser('scan', help='index the online roots, all of them if no name is given')
+    scan.add_argument('names', nargs='*')
+    scan.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    _add_io_arguments(scan)
+    scan.add_argument('--mode', choices=sample_modes, help='thumbnail sampling, the saved setting by default')
+    scan.set_defaults(func=_library_scan)
+
+    gc = commands.add_parser('gc', help='remove orphan caches and evict caches over the quota')
+    gc.add_argument('--quota', type=int, help='cache quota in MB, the saved setting by default')
+    gc.set_defaults(func=_gc)
+
+    stats = commands.add_parser('stats', help='print repository statistics')
+    stats.set_defaults(func=_stats)
+
+    args = parser.parse_args(argv)
+    # paths given on the command line are relative to where it was started, not to the work dir
+    perf_file = os.path.abspath(args.perf) if args.perf else None
+    if getattr(args, 'folders', None):
+        args.folders = [os.path.abspath(folder) for folder in args.folders]
+    if getattr(args, 'path', None):
+        args.path = os.path.abspath(args.path)
+    if args.workdir:
+        os.chdir(args.workdir)
+    if perf_file is None:
+        return args.func(args)
+    perf.enable()
+    try:
+        return args.func(args)
+    finally:
+        perf.export(perf_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import time
+import queue
+import socket
+import threading
+from video_file import *
+from job_queue import JobQueue
+from library import Library, MediaFinder, default_suffixes
+from utils.device_io import DeviceLimiter, device_of, read_ahead
+from utils import perf
+
+
+default_device_readers = 2
+
+# bounded queues in front of each stage, decoded frames wait in the encode and write queues
+default_queue_sizes = {
+    'probe': 16,
+    'decode': 4,
+    'encode': 4,
+    'write': 8
+}
+
+
+class _Item:
+    def __init__(self, job_id, path):
+        self.job_id = job_id
+        self.path = path
+        self.video = None
+        # 'decode' to grab the small frames, 'features' to compute features from the cache, None for nothing
+        self.action = None
+        self.nbytes = 0
+        self.error = None
+
+
+class PipelineMetrics:
+    def __init__(self, queues):
+        self.queues = queues
+        self.processed = {name: 0 for name in queues}
+        self.bytes_in_flight = 0
+        self.peak_bytes_in_flight = 0
+        self._lock = threading.Lock()
+
+    def count(self, stage):
+        with self._lock:
+            self.processed[stage] += 1
+
+    def add_bytes(self, nbytes):
+        with self._lock:
+            self.bytes_in_flight += nbytes
+            self.peak_bytes_in_flight = max(self.peak_bytes_in_flight, self.bytes_in_flight)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'queue_depth': {name: que.qsize() for name, que in self.queues.items()},
+                'processed': dict(self.processed),
+                'bytes_in_flight': self.bytes_in_flight,
+                'peak_bytes_in_flight': self.peak_bytes_in_flight
+            }
+
+
+class VideoProcess:
+    """
+    Indexing pipeline pulling jobs from the persisted JobQueue:
+    discover (claim jobs) -> probe (repository, fingerprint) -> decode (small frames) -> encode (png)
+    -> write (cache file, features, job state).
+    Each stage has a bounded queue in front of it, so a full queue blocks the stage before it and at
+    most a fixed number of videos hold decoded frames at any time, however long the backlog is.
+    """
+
+    def __init__(self, workers=1, mode=None, force=False, on_done=None, exit_when_idle=False, poll=2.0,
+                 queue_sizes=None, device_readers=None, read_ahead=None, library=None):
+        """
+        :param workers: number of decode threads, several processes or hosts may also share the job queue
+        :param mode: sampling mode, the sample_mode setting if None
+        :param force: grab the small frames again even if the cache exists
+        :param on_done: called with (path, ok) after each video, failed videos once they are given up
+        :param exit_when_idle: quit once there is no claimable job instead of waiting for new ones
+        :param poll: seconds between looking for jobs queued by others or with an expired lease
+        :param device_readers: concurrent decodes per spinning disk or network share, the device_readers setting
+        if None, 0 for no limit
+        :param read_ahead: prefetch the head and tail of each file before decoding, the read_ahead setting if None
+        :param library: roots with their offline state and limits, loaded from the repository if None
+        """
+        sizes = dict(default_queue_sizes)
+        if queue_sizes is not None:
+            sizes.update(queue_sizes)
+        self.queues = {name: queue.Queue(maxsize=size) for name, size in sizes.items()}
+        self.stages = [
+            ('probe', self._probe, 1),
+            ('decode', self._decode, workers),
+            ('encode', self._encode, max(1, workers // 2)),
+            ('write', self._write, 1)
+        ]
+        self.metrics = PipelineMetrics(self.queues)
+        if device_readers is None or read_ahead is None:
+            repo = Repository(cache_repo)
+            device_readers = repo.get_setting('device_readers', default_device_readers) \
+                if device_readers is None else device_readers
+            read_ahead = repo.get_setting('read_ahead', False) if read_ahead is None else read_ahead
+        self.devices = DeviceLimiter(device_readers or None, max_parked=sizes['decode'])
+        self.read_ahead = read_ahead
+        self.library = library or Library()
+        self._library_loaded = time.time()
+        self.mode = mode
+        self.force = force
+        self.on_done = on_done
+        self.exit_when_idle = exit_when_idle
+        self.poll = poll
+        # every thread has its own connection, they share one owner so any of them may complete a claimed job
+        self.owner = '%s:%d:%d' % (socket.gethostname(), os.getpid(), id(self))
+        self._is_stopped = False
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._running = dict()
+        self._threads = []
+        self._jobs = threading.local()
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._discover, name='video_discover'))
+        for index, (name, func, count) in enumerate(self.stages):
+            self._running[name] = count
+            for i in range(count):
+                self._threads.append(threading.Thread(target=self._run_stage, args=(index, func),
+                                                      name='video_%s_%d' % (name, i)))
+        heartbeat = threading.Thread(target=self._heartbeat, name='video_heartbeat', daemon=True)
+        for thread in self._threads:
+            thread.start()
+        heartbeat.start()
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(deadline - time.time(), 0))
+
+    def stop(self):
+        """
+        stop claiming jobs and wait until the videos already in the pipeline are written
+        """
+        self._is_stopped = True
+        self._wakeup.set()
+        self.join()
+
+    def process(self, path):
+        self.process_all([path])
+
+    def process_all(self, paths, reset=False):
+        """
+        :param reset: process paths again whose job is already done or failed
+        """
+        jobs = JobQueue()
+        jobs.put(paths, reset)
+        jobs.close()
+        self._wakeup.set()
+
+    def _job_queue(self):
+        # sqlite connections belong to the thread that opened them
+        if not hasattr(self._jobs, 'queue'):
+            self._jobs.queue = JobQueue(owner=self.owner)
+        return self._jobs.queue
+
+    def _discover(self):
+        jobs = self._job_queue()
+        probe = self.queues['probe']
+        # jobs parked by an earlier run are pending again if their root is back
+        self.library.check()
+        while not self._is_stopped:
+            if time.time() - self._library_loaded >= self.poll:
+                # roots may have gone offline or come back meanwhile
+                self.library.reload()
+                self.library.check()
+                self._library_loaded = time.time()
+            claimed = jobs.claim()
+            if len(claimed) == 0:
+                with self._lock:
+                    idle = len(self._in_flight) == 0
+                # a failed job in flight may come back as pending for another attempt
+                if self.exit_when_idle and idle:
+                    break
+                self._wakeup.wait(self.poll)
+                self._wakeup.clear()
+                continue
+            for job_id, path in claimed:
+                with self._lock:
+                    self._in_flight.add(job_id)
+                probe.put(_Item(job_id, path))
+        probe.put(None)
+        jobs.close()
+
+    def _heartbeat(self):
+        jobs = JobQueue(owner=self.owner)
+        last = time.time()
+        while self.is_alive():
+            time.sleep(1)
+            if time.time() - last < jobs.lease / 3:
+                continue
+            last = time.time()
+            with self._lock:
+                job_ids = list(self._in_flight)
+            jobs.heartbeat_all(job_ids)
+        jobs.close()
+
+    def _run_stage(self, index, func):
+        name = self.stages[index][0]
+        inbox = self.queues[name]
+        while True:
+            item = inbox.get()
+            if item is None:
+                # let the other workers of this stage see the end too
+                inbox.put(None)
+                break
+            # a failed item skips the remaining stages, the writer records the failure
+            next_stage = 'write'
+            try:
+                if item.error is None or name == 'write':
+                    with perf.timer('index/' + name):
+                        next_stage = func(item)
+            except Exception as e:
+                print('failed to %s %s: %s' % (name, item.path, e))
+                item.error = str(e)
+                if name == 'write':
+                    # the job stays running, another worker claims it again once its lease expired
+                    self._forget(item)
+                    next_stage = None
+            self.metrics.count(name)
+            if next_stage is not None:
+                self.queues[next_stage].put(item)
+        with self._lock:
+            self._running[name] -= 1
+            last = self._running[name] == 0
+        if last and index + 1 < len(self.stages):
+            self.queues[self.stages[index + 1][0]].put(None)
+        if last and hasattr(self._jobs, 'queue'):
+            self._jobs.queue.close()
+
+    def _probe(self, item):
+        if self.library.is_offline(item.path):
+            item.action = 'offline'
+            return 'write'
+        print('process ' + item.path)
+        video = VideoFile(path=item.path)
+        item.video = video
+        # a video replaced in place keeps its record, its cache and features are of the old content
+        modified = video.is_modified()
+        video.update_fingerprint()
+        if (self.force or modified or not video.is_cache_exist()) and (video.get_score() >= 0):
+            item.action = 'decode'
+            return 'decode'
+        if not video.has_features():
+            item.action = 'features'
+        return 'write'
+
+    def _read_limit(self, path):
+        """
+        :return: (key, readers) for the device limiter, a root with its own workers limit is limited as a whole
+        """
+        root = self.library.root_of(path)
+        if root is not None and root['workers']:
+            return 'root:' + root['name'], root['workers']
+        return device_of(path), None
+
+    def _read_ahead_of(self, path):
+        root = self.library.root_of(path)
+        if root is not None and root['read_ahead'] is not None:
+            return root['read_ahead']
+        return self.read_ahead
+
+    def _decode(self, item):
+        key, readers = self._read_limit(item.path)
+        if not self.devices.acquire_or_park(key, item, readers):
+            # a worker already reading the device decodes it later
+            return None
+        while item is not None:
+            self.queues[self._decode_one(item)].put(item)
+            item = self.devices.next_or_release(key, readers)
+        return None
+
+    def _decode_one(self, item):
+        video = item.video
+        try:
+            if self._read_ahead_of(item.path):
+                read_ahead(item.path)
+            video.decode_small_frames(self.mode)
+        except Exception as e:
+            print('failed to decode %s: %s' % (item.path, e))
+            item.error = str(e)
+            return 'write'
+        finally:
+            if video.screenshot is not None:
+                video.screenshot.release()
+                video.screenshot = None
+        self._track(item)
+        if len(video.small_cv_frames) == 0:
+            item.error = 'no frames decoded'
+            return 'write'
+        return 'encode'
+
+    def _encode(self, item):
+        item.video.encode_small_frames()
+        self._track(item)
+        return 'write'
+
+    def _write(self, item):
+        if item.action == 'offline':
+            # claimed before its root went offline, it waits for the root to come back
+            self._job_queue().park(item.job_id)
+            self._forget(item)
+            return None
+        video = item.video
+        try:
+            if item.error is None and item.action == 'decode':
+                video.save_cache()
+                video.update_features()
+            elif item.error is None and item.action == 'features' and video.load_cache(touch=False):
+                video.update_features()
+        except Exception as e:
+            print('failed to write %s: %s' % (item.path, e))
+            item.error = str(e)
+        ok = item.error is None
+        state = self._job_queue().complete(item.job_id, ok, item.error)
+        self._forget(item)
+        if state == 'pending':
+            self._wakeup.set()
+        elif self.on_done is not None:
+            self.on_done(item.path, ok)
+        return None
+
+    def _forget(self, item):
+        if item.video is not None:
+            item.video.close()
+        self._track(item)
+        with self._lock:
+            self._in_flight.discard(item.job_id)
+            idle = len(self._in_flight) == 0
+        if idle:
+            # the discover loop may be waiting for the last jobs before it quits
+            self._wakeup.set()
+
+    def _track(self, item):
+        nbytes = item.video.frames_nbytes() if item.video is not None else 0
+        self.metrics.add_bytes(nbytes - item.nbytes)
+        item.nbytes = nbytes